@@ -0,0 +1,123 @@
+"""Crawl a synthetic site served from a local process and report throughput,
+peak memory, event loop lag and database write rate. No network access is
+needed, and the site is the same on every run.
+
+    python benchmarks/bench_crawl.py --pages 2000 --body-kb 50 --latency 0.05
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+from multiprocessing import Process
+from typing import List
+
+from synthetic import SyntheticSite, run_site
+
+LAG_INTERVAL = 0.05
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Synthetic site did not start on port %d" % port)
+
+
+async def measure_lag(lags: List[float]) -> None:
+    """Record how late the event loop wakes up from short sleeps."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(loop.time() - started - LAG_INTERVAL)
+
+
+async def crawl(site: SyntheticSite, port: int, concurrency: int) -> None:
+    # Imported here, as the database URL is read on import:
+    from mediacrawl.config import CrawlConfig
+    from mediacrawl.crawler import Crawler
+    from mediacrawl.db import create_db
+
+    await create_db()
+    config = CrawlConfig.parse_obj(
+        {
+            "concurrency": concurrency,
+            "sites": [site.config(f"http://127.0.0.1:{port}")],
+        }
+    )
+    crawler = Crawler(config)
+    lags: List[float] = []
+    monitor = asyncio.create_task(measure_lag(lags))
+    started = time.monotonic()
+    await crawler.run(sites=[])
+    elapsed = time.monotonic() - started
+    monitor.cancel()
+
+    metrics = crawler.metrics
+    fetches = metrics.total("fetches")
+    written = metrics.total("pages_written")
+    write_time = sum(
+        h.sum for (n, _), h in metrics.histograms.items() if n == "db_write_seconds"
+    )
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    lags.sort()
+    print(f"pages fetched:   {fetches:.0f} in {elapsed:.2f}s")
+    print(f"pages/sec:       {fetches / elapsed:.1f}")
+    print(f"downloaded:      {metrics.total('bytes') / (1024 * 1024):.1f} MB")
+    print(f"peak RSS:        {peak_rss:.0f} MB")
+    if len(lags):
+        p99 = lags[int(len(lags) * 0.99)]
+        print(
+            f"loop lag:        p50 {lags[len(lags) // 2] * 1000:.1f} ms, "
+            f"p99 {p99 * 1000:.1f} ms, max {lags[-1] * 1000:.1f} ms"
+        )
+    if write_time > 0:
+        print(
+            f"DB writes:       {written:.0f} pages, {written / write_time:.0f} "
+            "pages/sec while writing"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--db", help="SQLite file to crawl into (default: temp)")
+    for name, field in SyntheticSite.__fields__.items():
+        flag = "--" + name.replace("_", "-")
+        parser.add_argument(flag, type=field.type_, default=field.default)
+    args = parser.parse_args()
+    site = SyntheticSite(**{n: getattr(args, n) for n in SyntheticSite.__fields__})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db or os.path.join(tmp, "crawl.db")
+        if os.path.exists(db_path):
+            sys.exit("Database already exists: %s" % db_path)
+        os.environ["MEDIACRAWL_DATABASE_URL"] = f"sqlite+aiosqlite:///{db_path}"
+        port = free_port()
+        server = Process(target=run_site, args=(site, port), daemon=True)
+        server.start()
+        try:
+            wait_for_port(port)
+            asyncio.run(crawl(site, port, args.concurrency))
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
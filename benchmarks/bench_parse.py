@@ -0,0 +1,92 @@
+"""Store synthetic article pages in a database and time parsing them with
+`Parser`, reporting pages/sec and peak memory.
+
+    python benchmarks/bench_parse.py --pages 1000 --body-kb 50 --workers 4
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+from pathlib import Path
+from datetime import datetime
+
+from synthetic import SyntheticSite, render_page
+
+BATCH_SIZE = 200
+
+
+async def store_pages(site: SyntheticSite, base_url: str) -> None:
+    from articledata import URL
+    from mediacrawl.db import create_db, db_connect
+    from mediacrawl.page import Page
+
+    await create_db()
+    batch = []
+    for index in range(site.pages):
+        status, content_type, body = render_page(site, index)
+        url = URL(f"{base_url}/article/{index}")
+        page = Page(
+            site="synthetic",
+            url=url,
+            original_url=url,
+            ok=status < 300,
+            retrieved=True,
+            status=status,
+            timestamp=datetime.utcnow(),
+            content_type=content_type,
+            charset="utf-8",
+            content=body,
+        )
+        batch.append(page)
+        if len(batch) >= BATCH_SIZE:
+            async with db_connect() as conn:
+                await Page.save_many(conn, batch)
+            batch = []
+    if len(batch):
+        async with db_connect() as conn:
+            await Page.save_many(conn, batch)
+
+
+async def parse(site: SyntheticSite, outpath: Path, workers: int) -> None:
+    # Imported here, as the database URL is read on import:
+    from mediacrawl.config import CrawlConfig
+    from mediacrawl.parser import Parser
+
+    base_url = "http://127.0.0.1:8700"
+    await store_pages(site, base_url)
+    config = CrawlConfig.parse_obj({"sites": [site.config(base_url)]})
+    parser = Parser(config)
+    started = time.monotonic()
+    await parser.run(outpath, sites=[], workers=workers)
+    elapsed = time.monotonic() - started
+    articles = 0
+    for path in outpath.glob("*.ijson"):
+        with open(path, "rb") as fh:
+            articles += sum(1 for _ in fh)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"pages parsed:    {site.pages} in {elapsed:.2f}s")
+    print(f"pages/sec:       {site.pages / elapsed:.1f}")
+    print(f"articles:        {articles}")
+    print(f"peak RSS:        {peak_rss:.0f} MB (main process)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=1)
+    for name, field in SyntheticSite.__fields__.items():
+        flag = "--" + name.replace("_", "-")
+        parser.add_argument(flag, type=field.type_, default=field.default)
+    args = parser.parse_args()
+    site = SyntheticSite(**{n: getattr(args, n) for n in SyntheticSite.__fields__})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "parse.db")
+        os.environ["MEDIACRAWL_DATABASE_URL"] = f"sqlite+aiosqlite:///{db_path}"
+        asyncio.run(parse(site, Path(tmp).joinpath("articles"), args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Compare evaluating crawl rules by walking the rule tree with the compiled
+evaluator, on a set of generated links.
+
+    python benchmarks/bench_rules.py [-n LINKS]
+"""
+
+import yaml
+import random
+import argparse
+from datetime import datetime
+from timeit import timeit
+from typing import List
+from articledata import URL
+
+from mediacrawl.config import SiteConfig
+from mediacrawl.page import Page
+
+SITE = """
+name: bench
+urls:
+  - https://www.example.com/
+crawl:
+  and:
+    - or:
+      - domain: example.com
+      - domain: example.org
+      - domain: news.example.net
+      - prefix: https://cdn.example.info/articles/
+      - prefix: https://static.example.info/stories/
+    - not:
+        or:
+          - pattern: ".*/(login|signup|account)/.*"
+          - pattern: ".*\\\\.(jpg|png|gif|pdf|zip)$"
+          - pattern: ".*/tag/.*"
+          - pattern: ".*/author/.*"
+          - pattern: ".*[?&]page=\\\\d+.*"
+    - not:
+        mime: nonweb
+    - or:
+        - element: .//article
+        - xpath: //meta[@property='og:type']
+"""
+
+HOSTS = [
+    "www.example.com",
+    "example.org",
+    "news.example.net",
+    "cdn.example.info",
+    "static.example.info",
+    "www.other.com",
+    "ads.tracker.io",
+]
+PATHS = [
+    "/",
+    "/news/2022/01/01/story-{}",
+    "/articles/{}",
+    "/stories/{}.html",
+    "/login/{}",
+    "/tag/{}",
+    "/author/{}",
+    "/images/{}.jpg",
+    "/list?page={}",
+]
+
+
+def generate_urls(count: int) -> List[URL]:
+    rand = random.Random(23)
+    urls: List[URL] = []
+    for i in range(count):
+        host = rand.choice(HOSTS)
+        path = rand.choice(PATHS).format(i)
+        urls.append(URL(f"https://{host}{path}"))
+    return urls
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--links", type=int, default=100_000)
+    args = parser.parse_args()
+
+    config = SiteConfig.parse_obj(yaml.safe_load(SITE))
+    rules = config.crawl
+    assert rules is not None
+    compiled = rules.compile()
+    urls = generate_urls(args.links)
+    page = Page(
+        url=URL("https://www.example.com/"),
+        original_url=URL("https://www.example.com/"),
+        timestamp=datetime.utcnow(),
+        ok=True,
+        retrieved=True,
+        status=200,
+        content_type="text/html",
+        content=b"<html><body><article>Story</article></body></html>",
+        site="bench",
+    )
+
+    for url in urls:
+        assert rules.check(url, None) == compiled(url, None), url
+        assert rules.check(url, page) == compiled(url, page), url
+
+    def tree_links() -> None:
+        for url in urls:
+            rules.check(url, None)
+
+    def compiled_links() -> None:
+        for url in urls:
+            compiled(url, None)
+
+    tree = timeit(tree_links, number=3) / 3
+    fast = timeit(compiled_links, number=3) / 3
+    print(f"links: {len(urls)}")
+    print(f"tree walk: {tree:.3f}s ({len(urls) / tree:,.0f} links/s)")
+    print(f"compiled:  {fast:.3f}s ({len(urls) / fast:,.0f} links/s)")
+    print(f"speedup:   {tree / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
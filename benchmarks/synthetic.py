@@ -0,0 +1,141 @@
+"""A synthetic news site for benchmarking: a graph of article pages with
+configurable size, fan-out, latency, error rate and share of non-web files.
+Pages are generated deterministically from their number, so every run of a
+benchmark sees the same site.
+
+    python benchmarks/synthetic.py --port 8700 --pages 1000
+"""
+
+import random
+import asyncio
+import argparse
+from typing import Dict, Tuple
+from aiohttp import web
+from pydantic import BaseModel
+
+WORDS = (
+    "the government report minister police court money investigation company "
+    "election bank city people year said would new first last market million "
+    "week state official public health school water energy climate border"
+).split()
+
+
+class SyntheticSite(BaseModel):
+    pages: int = 1000
+    fanout: int = 10
+    body_kb: int = 50
+    latency: float = 0.0
+    error_rate: float = 0.0
+    nonweb_rate: float = 0.05
+    seed: int = 1
+
+    def config(self, base_url: str) -> dict:
+        """A site configuration for crawling the site, with typical rules."""
+        return {
+            "name": "synthetic",
+            "urls": [f"{base_url}/"],
+            "crawl": {
+                "and": [
+                    {"domain": "127.0.0.1"},
+                    {"not": {"mime": "nonweb"}},
+                    {"not": {"pattern": ".*/(tag|author)/.*"}},
+                ]
+            },
+            "parse": {"element": ".//time"},
+        }
+
+
+def render_article(site: SyntheticSite, index: int) -> str:
+    rnd = random.Random(site.seed * 1_000_003 + index)
+    links = []
+    for _ in range(site.fanout):
+        target = rnd.randrange(site.pages)
+        if rnd.random() < site.nonweb_rate:
+            links.append(f'<a href="/files/{target}.pdf">Download</a>')
+        else:
+            links.append(f'<a href="/article/{target}">Read more</a>')
+    links.append(f'<a href="/tag/{rnd.choice(WORDS)}">Tag</a>')
+    links.append(f'<a href="https://example.com/share/{index}">Share</a>')
+    paragraphs = []
+    size = 0
+    while size < site.body_kb * 1024:
+        text = " ".join(rnd.choice(WORDS) for _ in range(80))
+        paragraph = f"<p>{text}.</p>\n"
+        paragraphs.append(paragraph)
+        size += len(paragraph)
+    title = " ".join(rnd.choice(WORDS) for _ in range(6)).capitalize()
+    return (
+        f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{title}</title>"
+        f"</head><body><nav>{''.join(links[:3])}</nav><article><h1>{title}</h1>"
+        f"<time datetime='2022-03-{1 + index % 28:02d}'>March</time>"
+        f"{''.join(paragraphs)}</article><aside>{''.join(links)}</aside>"
+        "</body></html>"
+    )
+
+
+def render_page(site: SyntheticSite, index: int) -> Tuple[int, str, bytes]:
+    """Generate the status, content type and body of an article page."""
+    rnd = random.Random(site.seed * 7_919 + index)
+    if index > 0 and rnd.random() < site.error_rate:
+        return 500, "text/html", b"<html><body>Internal error</body></html>"
+    return 200, "text/html", render_article(site, index).encode("utf-8")
+
+
+def make_app(site: SyntheticSite) -> web.Application:
+    # Pages are rendered once, so that serving them costs little CPU time
+    # next to the crawler being measured:
+    rendered: Dict[int, Tuple[int, str, bytes]] = {}
+
+    async def respond(index: int) -> web.Response:
+        if site.latency > 0:
+            await asyncio.sleep(site.latency)
+        if index not in rendered:
+            rendered[index] = render_page(site, index)
+        status, content_type, body = rendered[index]
+        return web.Response(
+            status=status, body=body, content_type=content_type, charset="utf-8"
+        )
+
+    async def index(request: web.Request) -> web.Response:
+        return await respond(0)
+
+    async def article(request: web.Request) -> web.Response:
+        index = int(request.match_info["index"])
+        if index >= site.pages:
+            raise web.HTTPNotFound()
+        return await respond(index)
+
+    async def tag(request: web.Request) -> web.Response:
+        return await respond(0)
+
+    async def file(request: web.Request) -> web.Response:
+        if site.latency > 0:
+            await asyncio.sleep(site.latency)
+        body = b"%PDF-1.4\n" + bytes(site.body_kb * 1024)
+        return web.Response(body=body, content_type="application/pdf")
+
+    app = web.Application()
+    app.router.add_get("/", index)
+    app.router.add_get("/article/{index:\\d+}", article)
+    app.router.add_get("/tag/{name}", tag)
+    app.router.add_get("/files/{index:\\d+}.pdf", file)
+    return app
+
+
+def run_site(site: SyntheticSite, port: int) -> None:
+    web.run_app(make_app(site), host="127.0.0.1", port=port, print=None)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8700)
+    for name, field in SyntheticSite.__fields__.items():
+        flag = "--" + name.replace("_", "-")
+        parser.add_argument(flag, type=field.type_, default=field.default)
+    args = parser.parse_args()
+    options = {n: getattr(args, n) for n in SyntheticSite.__fields__}
+    run_site(SyntheticSite(**options), args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,19 @@
-from typing import List
+from typing import List, Optional, Tuple
 import click
 import logging
 import asyncio
 from pathlib import Path
 from functools import wraps
+from zstandard import ZstdError
 
 from mediacrawl.config import CrawlConfig
 from mediacrawl.crawler import Crawler
+from mediacrawl.codec import load_dictionaries, train_dictionary
+from mediacrawl.export import APPEND_FORMATS, FORMATS, JSONL, ROTATE_SIZE
+from mediacrawl.page import Page
 from mediacrawl.parser import Parser
-from mediacrawl.db import create_db
+from mediacrawl.pipeline import ParsePipeline
+from mediacrawl.db import create_db, db_connect
 
 
 log = logging.getLogger(__name__)
@@ -31,14 +36,100 @@ def cli() -> None:
     logging.basicConfig(level=logging.INFO)
 
 
+def parse_shard(ctx, param, value: Optional[str]) -> Optional[Tuple[int, int]]:
+    if value is None:
+        return None
+    try:
+        index, count = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("must be given as INDEX/COUNT, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise click.BadParameter("index must be between 0 and COUNT - 1")
+    return index, count
+
+
 @cli.command("crawl", help="Crawl the news")
 @click.argument("config", type=InPath)
 @click.option("-s", "--site", "sites", multiple=True)
+@click.option(
+    "--shard",
+    callback=parse_shard,
+    default=None,
+    help="Only crawl one shard of the hosts, as INDEX/COUNT (e.g. 0/4)",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    default=None,
+    help="Serve Prometheus metrics on this local port",
+)
+@click.option(
+    "--discover",
+    is_flag=True,
+    default=False,
+    help="Find new pages from sitemaps and feeds instead of following all links",
+)
+@click.option(
+    "--parse",
+    "parse_",
+    is_flag=True,
+    default=False,
+    help="Parse pages as they are crawled, appending to the article files",
+)
+@click.option("-o", "--outpath", "outpath", type=OutDir, default="data/articles")
+@click.option(
+    "-w",
+    "--workers",
+    "workers",
+    type=int,
+    default=2,
+    help="Number of processes to parse pages with, with --parse",
+)
+@click.option(
+    "-f",
+    "--format",
+    "format",
+    type=click.Choice(APPEND_FORMATS),
+    default=JSONL,
+    help="Output format with --parse: JSON lines or compressed JSON lines",
+)
+@click.option(
+    "--rotate-mb",
+    type=int,
+    default=ROTATE_SIZE // (1024 * 1024),
+    help="Start a new compressed JSON lines file after this many MB",
+)
 @async_command
-async def crawl(config: Path, sites: List[str]) -> None:
+async def crawl(
+    config: Path,
+    sites: List[str],
+    shard: Optional[Tuple[int, int]],
+    metrics_port: Optional[int],
+    discover: bool,
+    parse_: bool,
+    outpath: Path,
+    workers: int,
+    format: str,
+    rotate_mb: int,
+) -> None:
     with open(config, "r") as fh:
         config_ = CrawlConfig.parse_raw(fh.read())
-    crawler = Crawler(config_)
+    pipeline = None
+    if parse_:
+        pipeline = ParsePipeline(
+            config_,
+            outpath,
+            workers=workers,
+            format=format,
+            rotate_size=rotate_mb * 1024 * 1024,
+        )
+    crawler = Crawler(
+        config_,
+        shard=shard,
+        metrics_port=metrics_port,
+        discover=discover,
+        pipeline=pipeline,
+    )
     await crawler.run(sites=sites)
 
 
@@ -46,12 +137,87 @@ async def crawl(config: Path, sites: List[str]) -> None:
 @click.argument("config", type=InPath)
 @click.option("-o", "--outpath", "outpath", type=OutDir, default="data/articles")
 @click.option("-s", "--site", "sites", multiple=True)
+@click.option(
+    "--dedupe",
+    is_flag=True,
+    default=False,
+    help="Extract pages with identical content only once",
+)
+@click.option(
+    "-w",
+    "--workers",
+    "workers",
+    type=int,
+    default=1,
+    help="Number of processes to parse pages with",
+)
+@click.option(
+    "-i",
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only parse pages which changed since the last run",
+)
+@click.option(
+    "-f",
+    "--format",
+    "format",
+    type=click.Choice(FORMATS),
+    default=JSONL,
+    help="Output format: JSON lines, compressed JSON lines, Parquet or Arrow",
+)
+@click.option(
+    "--rotate-mb",
+    type=int,
+    default=ROTATE_SIZE // (1024 * 1024),
+    help="Start a new compressed JSON lines file after this many MB",
+)
+@async_command
+async def parse(
+    config: Path,
+    outpath: Path,
+    sites: List[str],
+    dedupe: bool,
+    workers: int,
+    incremental: bool,
+    format: str,
+    rotate_mb: int,
+) -> None:
+    if incremental and format != JSONL:
+        raise click.BadParameter(
+            "only supported with the jsonl format", param_hint="--incremental"
+        )
+    with open(config, "r") as fh:
+        config_ = CrawlConfig.parse_raw(fh.read())
+    parser = Parser(config_, dedupe=dedupe)
+    await parser.run(
+        outpath,
+        sites,
+        workers=workers,
+        incremental=incremental,
+        format=format,
+        rotate_size=rotate_mb * 1024 * 1024,
+    )
+
+
+@cli.command("train", help="Train page compression dictionaries")
+@click.argument("config", type=InPath)
+@click.option("-s", "--site", "sites", multiple=True)
+@click.option("-n", "--samples", "samples", type=int, default=2000)
 @async_command
-async def parse(config: Path, outpath: Path, sites: List[str]) -> None:
+async def train(config: Path, sites: List[str], samples: int) -> None:
     with open(config, "r") as fh:
         config_ = CrawlConfig.parse_raw(fh.read())
-    parser = Parser(config_)
-    await parser.run(outpath, sites)
+    async with db_connect() as conn:
+        await load_dictionaries(conn)
+        for site in config_.sites:
+            if len(sites) and site.name not in sites:
+                continue
+            bodies = await Page.sample_content(conn, site.name, samples)
+            try:
+                await train_dictionary(conn, site.name, bodies)
+            except ZstdError as ze:
+                log.warning("Cannot train dictionary [%s]: %s", site.name, ze)
 
 
 @cli.command("init", help="Initialize the database")
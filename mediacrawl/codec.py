@@ -0,0 +1,83 @@
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.future import select
+from zstandard import ZstdCompressionDict, ZstdCompressor, ZstdDecompressor
+from zstandard import train_dictionary as zstd_train
+
+from mediacrawl.db import Conn, dictionary_table
+
+ZSTD = "zstd"
+LEVEL = 3
+DICT_SIZE = 1024 * 112
+
+log = logging.getLogger(__name__)
+
+# Trained dictionaries by ID, and the ID of the latest dictionary for each site:
+dictionaries: Dict[int, ZstdCompressionDict] = {}
+site_dictionaries: Dict[str, int] = {}
+compressors: Dict[Optional[int], ZstdCompressor] = {}
+decompressors: Dict[Optional[int], ZstdDecompressor] = {}
+
+
+def get_compressor(dict_id: Optional[int]) -> ZstdCompressor:
+    if dict_id not in compressors:
+        dict_data = None if dict_id is None else dictionaries[dict_id]
+        compressors[dict_id] = ZstdCompressor(level=LEVEL, dict_data=dict_data)
+    return compressors[dict_id]
+
+
+def get_decompressor(dict_id: Optional[int]) -> ZstdDecompressor:
+    if dict_id not in decompressors:
+        dict_data = None if dict_id is None else dictionaries[dict_id]
+        decompressors[dict_id] = ZstdDecompressor(dict_data=dict_data)
+    return decompressors[dict_id]
+
+
+def compress(
+    site: str, content: Optional[bytes]
+) -> Tuple[Optional[str], Optional[bytes]]:
+    """Compress a page body, using the site's dictionary if one has been trained.
+    Returns the codec name to be stored alongside the data."""
+    if content is None:
+        return None, None
+    dict_id = site_dictionaries.get(site)
+    data = get_compressor(dict_id).compress(content)
+    if dict_id is None:
+        return ZSTD, data
+    return f"{ZSTD}:{dict_id}", data
+
+
+def decompress(codec: Optional[str], data: Optional[bytes]) -> Optional[bytes]:
+    """Decode a stored page body. Bodies stored without a codec are returned as-is."""
+    if codec is None or data is None:
+        return data
+    name, _, dict_ref = codec.partition(":")
+    if name != ZSTD:
+        raise ValueError("Unknown content codec: %r" % codec)
+    dict_id = int(dict_ref) if len(dict_ref) else None
+    return get_decompressor(dict_id).decompress(data)
+
+
+async def load_dictionaries(conn: Conn) -> None:
+    stmt = select(dictionary_table)
+    stmt = stmt.order_by(dictionary_table.c.id.asc())
+    result = await conn.execute(stmt)
+    for row in result.fetchall():
+        dictionaries[row.id] = ZstdCompressionDict(row.data)
+        site_dictionaries[row.site] = row.id
+
+
+async def train_dictionary(conn: Conn, site: str, samples: List[bytes]) -> int:
+    """Train a compression dictionary from sample page bodies of the site, and
+    make it the one used for the site's pages from now on."""
+    trained = zstd_train(DICT_SIZE, samples)
+    stmt = dictionary_table.insert().values(
+        site=site, timestamp=datetime.utcnow(), data=trained.as_bytes()
+    )
+    result = await conn.execute(stmt)
+    (dict_id,) = result.inserted_primary_key
+    dictionaries[dict_id] = trained
+    site_dictionaries[site] = dict_id
+    log.info("Trained dictionary [%s]: %d samples, id %d", site, len(samples), dict_id)
+    return dict_id
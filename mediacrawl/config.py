@@ -1,4 +1,4 @@
-from typing import List, Optional, Set
+from typing import List, Literal, Optional, Set
 from pydantic import BaseModel, validator
 from pydantic_yaml import YamlModel
 from articledata import URL
@@ -6,23 +6,57 @@ from articledata import URL
 from mediacrawl.rule import Rules
 
 
+class RetryConfig(BaseModel):
+    # Number of times a URL is fetched before it is given up on:
+    attempts: int = 3
+    # Seconds to wait before the first retry, doubled for each further one:
+    backoff: float = 2.0
+    # Responses which are retried; connection errors and timeouts always are:
+    statuses: Set[int] = {408, 429, 500, 502, 503, 504}
+
+
 class SiteConfig(BaseModel):
     name: str
     delay: float = 0.0
     domain_concurrency: int = 10
+    # Adjust the concurrency per domain (up to `domain_concurrency`) to how
+    # quickly and reliably it responds:
+    adaptive: bool = True
+    max_content: Optional[int] = None
+    # Crawl budget: the number of links followed from a seed, and the number of
+    # pages fetched and seconds spent on the site in each run. Any URLs left
+    # over stay in the frontier for the next run:
+    max_depth: Optional[int] = None
+    max_pages: Optional[int] = None
+    max_time: Optional[float] = None
+    retry: RetryConfig = RetryConfig()
     urls: Set[URL]
+    # Sitemaps and RSS/Atom feeds read by `crawl --discover`, along with the
+    # sitemaps listed in robots.txt if `robots` is set:
+    feeds: Set[URL] = set()
+    robots: bool = True
     query_ignore: Set[str] = set()
     crawl: Optional[Rules]
     parse: Optional[Rules]
 
-    @validator("urls", each_item=True)
+    @validator("urls", "feeds", each_item=True)
     def convert_url(cls, url: Optional[str]) -> Optional[URL]:
         if url is None:
             return None
         return URL(url)
 
 
+class SeenConfig(BaseModel):
+    mode: Literal["exact", "bloom"] = "exact"
+    # Only used by the bloom filter, which is sized for `capacity` URLs:
+    capacity: int = 10_000_000
+    error_rate: float = 0.0001
+
+
 class CrawlConfig(YamlModel):
     concurrency: int = 100
     user_agent: str = "Mozilla/5.0 (storyweb)"
+    seen: SeenConfig = SeenConfig()
+    # Minimum confidence for a detected article language to be used:
+    language_threshold: float = 0.0
     sites: List[SiteConfig]
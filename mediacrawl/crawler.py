@@ -1,60 +1,217 @@
+import time
 import asyncio
 import logging
-from asyncio import CancelledError, Queue
-from typing import List, Set
+from asyncio import CancelledError
+from typing import Dict, List, Optional, Tuple
 from aiohttp import ClientSession, TCPConnector
 from aiohttp.client import ClientTimeout
-from articledata import URL
 
+from mediacrawl.codec import load_dictionaries
 from mediacrawl.config import CrawlConfig
+from mediacrawl.db import db_connect
+from mediacrawl.discovery import Discovery
+from mediacrawl.frontier import SEED, SITEMAP, Frontier
+from mediacrawl.metrics import Metrics
+from mediacrawl.pipeline import ParsePipeline
+from mediacrawl.scheduler import Scheduler
+from mediacrawl.seen import create_seen
 from mediacrawl.site import Site
 from mediacrawl.task import Task
+from mediacrawl.writer import PageWriter
 
+# How many tasks per worker may be waiting for their host before no
+# further work is taken from the frontier:
+MAX_DEFERRED = 100
 log = logging.getLogger(__name__)
 
 
 class Crawler(object):
-    def __init__(self, config: CrawlConfig) -> None:
+    def __init__(
+        self,
+        config: CrawlConfig,
+        shard: Optional[Tuple[int, int]] = None,
+        metrics_port: Optional[int] = None,
+        discover: bool = False,
+        pipeline: Optional[ParsePipeline] = None,
+    ) -> None:
         self.config = config
+        self.discover = discover
+        # Parses pages as they are crawled, see `crawl --parse`:
+        self.pipeline = pipeline
         self.sites = [Site(self, c) for c in config.sites]
-        self.queue = Queue[Task]()
-        self.seen: Set[URL] = set()
+        self.scheduler = Scheduler()
+        self.frontier = Frontier(shard=shard)
+        self.seen = create_seen(config.seen)
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.writer = PageWriter(self.metrics, self.frontier)
+        self.active = 0
+        self.metrics.gauge("queued", lambda: len(self.scheduler.incoming))
+        self.metrics.gauge("deferred", lambda: self.scheduler.deferred)
+        self.metrics.gauge("retrying", lambda: len(self.scheduler.retries))
+        self.metrics.gauge("active", lambda: self.active)
+        self.metrics.gauge("write_pending", lambda: self.writer.queue.qsize())
+        if pipeline is not None:
+            self.metrics.gauge("parse_pending", lambda: pipeline.queue.qsize())
 
     async def worker(self, session: ClientSession):
         try:
             while True:
-                page = await self.queue.get()
+                task, fetch = await self.scheduler.get()
+                if task.site.exhausted:
+                    # Left active in the frontier, to be resumed next run:
+                    if fetch:
+                        self.scheduler.release(task)
+                    self.stop_site(task.site)
+                    continue
+                self.active += 1
+                done = True
                 try:
-                    await page.crawl(session)
-                except Exception:
-                    log.exception("Failed to crawl page: %r" % page)
-                self.queue.task_done()
+                    if fetch:
+                        waited = time.monotonic() - task.deferred_at
+                        site = task.site.config.name
+                        self.metrics.observe("host_wait_seconds", waited, site=site)
+                        try:
+                            await task.fetch(session)
+                        finally:
+                            self.scheduler.release(task)
+                        if task.should_retry:
+                            self.retry(task)
+                            done = False
+                    elif not await task.lookup():
+                        task.deferred_at = time.monotonic()
+                        self.scheduler.defer(task)
+                        done = False
+                except Exception as exc:
+                    site = task.site.config.name
+                    self.metrics.inc("errors", site=site, error=type(exc).__name__)
+                    log.exception("Failed to crawl page: %r" % task)
+                # Pages handed to the writer are completed once stored:
+                if done and not task.stored:
+                    self.frontier.complete(task.url)
+                self.active -= 1
         except KeyboardInterrupt:
             pass
 
-    async def run(self, sites: List[str]):
-        for site in self.sites:
-            if len(sites) and site.config.name not in sites:
+    def stop_site(self, site: Site) -> None:
+        name = site.config.name
+        if name in self.frontier.sites:
+            log.info("Crawl budget used up [%s]: %d pages", name, site.fetched)
+            self.frontier.stop(name)
+
+    def retry(self, task: Task) -> None:
+        """Schedule a failed fetch to be made again, or record the URL as failed
+        once the site's attempt budget is used up."""
+        if task.attempts < task.site.config.retry.attempts:
+            delay = task.retry_delay
+            self.metrics.inc("retries", site=task.site_name)
+            log.info("Retry in %.1fs [%s]: %r", delay, task.error, task.url)
+            self.scheduler.retry(task, delay)
+            return
+        self.metrics.inc("failures", site=task.site_name)
+        log.warning("Failed [%s, %d attempts]: %r", task.error, task.attempts, task.url)
+        self.frontier.fail(task.url, task.attempts, task.error)
+
+    async def feed(self, sites: Dict[str, Site]):
+        """Keep the scheduler topped up with URLs from the frontier until all
+        of it has been crawled. When crawling a shard of the frontier, this
+        waits for the crawlers of the other shards to finish too, since they
+        can still discover URLs in this one."""
+        limit = self.config.concurrency * 2
+        while True:
+            if (
+                len(self.scheduler.incoming) >= self.config.concurrency
+                or self.scheduler.deferred >= self.config.concurrency * MAX_DEFERRED
+            ):
+                await asyncio.sleep(0.1)
                 continue
-            for seed_task in site.seeds():
-                self.seen.add(seed_task.url)
-                await self.queue.put(seed_task)
+            async with db_connect() as conn:
+                await self.frontier.flush(conn)
+                claimed = await self.frontier.claim(conn, limit)
+            for site_name, url, depth, source in claimed:
+                task = Task(sites[site_name], url, depth=depth, source=source)
+                self.scheduler.put(task)
+            if not len(claimed):
+                if self.scheduler.empty and self.active == 0:
+                    async with db_connect() as conn:
+                        await self.frontier.flush(conn)
+                        if not await self.frontier.count_open(conn):
+                            break
+                await asyncio.sleep(0.5)
+
+    async def discover_urls(self, session: ClientSession, site: Site) -> None:
+        """Queue the pages which sitemaps and feeds list as new or modified,
+        instead of walking the site's links to find them."""
+        discovery = Discovery(site, session)
+        for url in await discovery.run():
+            if self.seen.add(url):
+                priority = site.score(url, 0, SITEMAP)
+                self.frontier.push(site.config.name, url, 0, SITEMAP, priority)
+        site.refresh.update(discovery.updated)
+        self.metrics.inc("discovered", len(discovery.urls), site=site.config.name)
+
+    async def run(self, sites: List[str]):
+        active: Dict[str, Site] = {}
+        fresh: List[Site] = []
+        async with db_connect() as conn:
+            await load_dictionaries(conn)
+            for site in self.sites:
+                if len(sites) and site.config.name not in sites:
+                    continue
+                active[site.config.name] = site
+                if await self.frontier.resume(conn, site.config.name):
+                    log.info("Resuming crawl: %s", site)
+                    async for url in self.frontier.iter_urls(conn, site.config.name):
+                        self.seen.add(url)
+                    continue
+                fresh.append(site)
+                for seed_task in site.seeds():
+                    self.seen.add(seed_task.url)
+                    priority = site.score(seed_task.url, 0, SEED)
+                    self.frontier.push(
+                        site.config.name, seed_task.url, 0, SEED, priority
+                    )
 
         headers = {"User-Agent": self.config.user_agent}
         timeout = ClientTimeout(10)
-        connector = TCPConnector(limit_per_host=5)
+        if self.discover:
+            async with ClientSession(headers=headers, timeout=timeout) as session:
+                discoveries = [self.discover_urls(session, s) for s in fresh]
+                await asyncio.gather(*discoveries)
+        # Requests per host are limited by the scheduler:
+        connector = TCPConnector(limit=self.config.concurrency, limit_per_host=0)
         async with ClientSession(
             headers=headers, timeout=timeout, connector=connector
         ) as session:
+            runner = None
+            if self.metrics_port is not None:
+                runner = await self.metrics.serve(self.metrics_port)
+            reporter = asyncio.create_task(self.metrics.report())
+            self.writer.start()
+            if self.pipeline is not None:
+                self.pipeline.start(self.metrics)
             tasks: List[asyncio.Task[Task]] = []
+            for site in active.values():
+                site.start()
             for _ in range(self.config.concurrency):
                 task = asyncio.create_task(self.worker(session))
                 tasks.append(task)
 
-            await self.queue.join()
-            for task in tasks:
-                task.cancel()
-            resp = await asyncio.gather(*tasks, return_exceptions=True)
-            for exc in resp:
-                if not isinstance(exc, CancelledError):
-                    log.error("Collected error: %r" % exc)
+            try:
+                await self.feed(active)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                resp = await asyncio.gather(*tasks, return_exceptions=True)
+                for exc in resp:
+                    if not isinstance(exc, CancelledError):
+                        log.error("Collected error: %r" % exc)
+                await self.writer.close()
+                if self.pipeline is not None:
+                    await self.pipeline.close()
+                async with db_connect() as conn:
+                    await self.frontier.flush(conn)
+                reporter.cancel()
+                self.metrics.summarize()
+                if runner is not None:
+                    await runner.cleanup()
@@ -44,5 +44,60 @@ page_table = Table(
     Column("headers", Unicode()),
     Column("content_type", Unicode(1024)),
     Column("charset", Unicode(1024)),
+    # The encoding the page body was decoded with:
+    Column("encoding", Unicode(64), nullable=True),
+    Column("content_hash", Unicode(64), nullable=True, index=True),
+    Column("codec", Unicode(64), nullable=True),
     Column("content", LargeBinary, nullable=True),
+    # Number of links found on the page, NULL if they were not extracted:
+    Column("outlinks", Integer, nullable=True),
+)
+
+body_table = Table(
+    "body",
+    meta,
+    Column("hash", Unicode(64), primary_key=True),
+    Column("codec", Unicode(64), nullable=True),
+    Column("content", LargeBinary, nullable=False),
+)
+
+
+dictionary_table = Table(
+    "dictionary",
+    meta,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("site", Unicode(1024), index=True),
+    Column("timestamp", DateTime, nullable=False),
+    Column("data", LargeBinary, nullable=False),
+)
+
+parsed_table = Table(
+    "parsed",
+    meta,
+    Column("url", Unicode(8192), primary_key=True),
+    Column("site", Unicode(1024), index=True),
+    Column("content_hash", Unicode(64), nullable=True),
+    Column("timestamp", DateTime, nullable=False),
+)
+
+link_table = Table(
+    "link",
+    meta,
+    Column("source", Unicode(8192), primary_key=True),
+    Column("target", Unicode(8192), primary_key=True, index=True),
+)
+
+frontier_table = Table(
+    "frontier",
+    meta,
+    Column("site", Unicode(1024), index=True),
+    Column("url", Unicode(8192), primary_key=True),
+    Column("host_hash", Integer, nullable=True),
+    Column("state", Unicode(16), index=True),
+    Column("depth", Integer, nullable=True),
+    Column("source", Unicode(16), nullable=True),
+    Column("priority", Integer, nullable=True, index=True),
+    Column("attempts", Integer, nullable=True),
+    Column("error", Unicode(1024), nullable=True),
+    Column("timestamp", DateTime, nullable=False),
 )
@@ -0,0 +1,302 @@
+import re
+import zlib
+import logging
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+from asyncio.exceptions import TimeoutError
+from aiohttp import ClientSession
+from aiohttp.client_exceptions import ClientError
+from lxml import etree
+from sqlalchemy.future import select
+from sqlalchemy import func
+from articledata import URL
+
+from mediacrawl.db import db_connect, page_table
+
+if TYPE_CHECKING:
+    from mediacrawl.site import Site
+
+SITEMAP = "sitemap"
+PAGE = "page"
+CHUNK_SIZE = 1024 * 64
+# Number of discovered URLs checked against the database at once:
+BATCH_SIZE = 500
+# Upper bound on the sitemaps read for one site, e.g. from nested indexes:
+MAX_SITEMAPS = 1000
+GZIP_MAGIC = b"\x1f\x8b"
+# W3C date and time: YYYY, YYYY-MM, YYYY-MM-DD, or a date with the time to the
+# minute, second or fraction of a second, and a `Z` or `+hh:mm` time zone.
+# `datetime.fromisoformat` only accepts most of these from Python 3.11 on:
+W3C_DATE = re.compile(
+    r"^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d+))?)?"
+    r"\s*(Z|[+-]\d{2}:?\d{2})?)?)?)?$"
+)
+# Elements listing a sitemap (in an index), a page (in a sitemap), an RSS item
+# or an Atom entry, in any namespace:
+ENTRY_TAGS = ["{*}sitemap", "{*}url", "{*}item", "{*}entry"]
+
+Entry = Tuple[str, str, Optional[datetime]]
+log = logging.getLogger(__name__)
+
+
+def parse_w3c_date(value: str) -> Optional[datetime]:
+    match = W3C_DATE.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    micro = int((fraction or "0")[:6].ljust(6, "0"))
+    tzinfo: Optional[timezone] = None
+    if zone == "Z":
+        tzinfo = timezone.utc
+    elif zone is not None:
+        sign = -1 if zone[0] == "-" else 1
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[-2:]))
+        tzinfo = timezone(sign * offset)
+    try:
+        return datetime(
+            int(year),
+            int(month or 1),
+            int(day or 1),
+            int(hour or 0),
+            int(minute or 0),
+            int(second or 0),
+            micro,
+            tzinfo=tzinfo,
+        )
+    except ValueError:
+        return None
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    """Parse a W3C (sitemap, Atom) or RFC 822 (RSS) date to naive UTC, the way
+    page timestamps are stored."""
+    if value is None:
+        return None
+    value = value.strip()
+    date = parse_w3c_date(value)
+    if date is None:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def local_name(el: etree._Element) -> Optional[str]:
+    if not isinstance(el.tag, str):
+        return None
+    return el.tag.rpartition("}")[2]
+
+
+def child_text(el: etree._Element, *names: str) -> Optional[str]:
+    for child in el:
+        if local_name(child) in names and child.text is not None:
+            return child.text.strip()
+    return None
+
+
+class FeedParser(object):
+    """Incrementally parse a sitemap, sitemap index, RSS or Atom feed, given in
+    chunks of (possibly gzipped) bytes. Elements are dropped once they've been
+    read, so that large sitemaps don't have to be held in memory."""
+
+    def __init__(self) -> None:
+        self.parser = etree.XMLPullParser(
+            events=("end",),
+            tag=ENTRY_TAGS,
+            recover=True,
+            resolve_entities=False,
+            no_network=True,
+            huge_tree=True,
+        )
+        self.gzip: Optional["zlib._Decompress"] = None
+        self.started = False
+
+    def feed(self, data: bytes) -> List[Entry]:
+        if not self.started:
+            self.started = True
+            if data.startswith(GZIP_MAGIC):
+                self.gzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.gzip is not None:
+            data = self.gzip.decompress(data)
+        self.parser.feed(data)
+        return self.read_events()
+
+    def close(self) -> List[Entry]:
+        try:
+            self.parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        return self.read_events()
+
+    def read_events(self) -> List[Entry]:
+        entries: List[Entry] = []
+        for _, el in self.parser.read_events():
+            entry = self.read_entry(el)
+            if entry is None:
+                continue
+            entries.append(entry)
+            el.clear()
+            parent = el.getparent()
+            if parent is not None:
+                while el.getprevious() is not None:
+                    del parent[0]
+        return entries
+
+    def read_entry(self, el: etree._Element) -> Optional[Entry]:
+        name = local_name(el)
+        if name == "sitemap":
+            loc = child_text(el, "loc")
+            if loc is not None:
+                return SITEMAP, loc, parse_date(child_text(el, "lastmod"))
+        elif name == "url":
+            # Images in RSS also have a <url>, but no <loc>:
+            loc = child_text(el, "loc")
+            if loc is not None:
+                date = child_text(el, "lastmod")
+                for child in el:
+                    if local_name(child) == "news":
+                        date = child_text(child, "publication_date") or date
+                return PAGE, loc, parse_date(date)
+        elif name == "item":
+            link = child_text(el, "link")
+            if link is not None:
+                date = child_text(el, "pubDate", "date")
+                return PAGE, link, parse_date(date)
+        elif name == "entry":
+            for child in el:
+                if local_name(child) != "link":
+                    continue
+                if child.get("rel", "alternate") == "alternate":
+                    href = child.get("href")
+                    if href is not None:
+                        date = child_text(el, "updated", "published")
+                        return PAGE, href, parse_date(date)
+        return None
+
+
+class Discovery(object):
+    """Find the new and updated pages of a site from the sitemaps listed in the
+    robots.txt of its seed hosts and the feeds in its configuration, without
+    walking its link graph."""
+
+    def __init__(self, site: "Site", session: ClientSession) -> None:
+        self.site = site
+        self.session = session
+        self.urls: List[URL] = []
+        # Stored pages which were modified since they were fetched:
+        self.updated: Set[URL] = set()
+        self.since: Optional[datetime] = None
+        self.fetched: Set[str] = set()
+        self.found: Dict[str, Optional[datetime]] = {}
+
+    @property
+    def name(self) -> str:
+        return self.site.config.name
+
+    async def robots_sitemaps(self) -> List[str]:
+        hosts = set((u.scheme, u.parsed.netloc) for u in self.site.config.urls)
+        sitemaps: List[str] = []
+        for scheme, netloc in sorted(hosts):
+            url = f"{scheme}://{netloc}/robots.txt"
+            try:
+                async with self.session.get(url) as response:
+                    if response.status != 200:
+                        continue
+                    text = await response.text(errors="replace")
+            except (ClientError, TimeoutError) as exc:
+                log.warning("Cannot read robots.txt [%s]: %r", url, exc)
+                continue
+            for line in text.splitlines():
+                key, _, value = line.partition(":")
+                if key.strip().lower() == "sitemap" and len(value.strip()):
+                    sitemaps.append(value.strip())
+        return sitemaps
+
+    async def read(self, url: str) -> List[str]:
+        """Read a sitemap or feed, collecting the pages it lists and returning
+        the nested sitemaps which changed since the site was last crawled."""
+        self.fetched.add(url)
+        parser = FeedParser()
+        nested: List[str] = []
+        try:
+            async with self.session.get(url) as response:
+                if response.status != 200:
+                    log.warning("Cannot read sitemap [%d]: %s", response.status, url)
+                    return nested
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    for entry in parser.feed(chunk):
+                        await self.handle(entry, nested)
+        except (ClientError, TimeoutError, zlib.error) as exc:
+            log.warning("Cannot read sitemap [%s]: %r", url, exc)
+        for entry in parser.close():
+            await self.handle(entry, nested)
+        return nested
+
+    async def handle(self, entry: Entry, nested: List[str]) -> None:
+        kind, loc, date = entry
+        if kind == SITEMAP:
+            if self.since is None or date is None or date > self.since:
+                nested.append(loc)
+            return
+        # Sitemaps and feeds of other sites may list broken URLs:
+        try:
+            url = URL(loc)
+            if url.scheme not in ["http", "https"]:
+                return
+            url = url.clean(self.site.config.query_ignore)
+        except ValueError as exc:
+            log.warning("Invalid URL in sitemap [%s]: %r", exc, loc)
+            return
+        if self.site.crawl_rules is not None:
+            if self.site.crawl_rules(url, None) is False:
+                return
+        self.found[url.url] = date
+        if len(self.found) >= BATCH_SIZE:
+            await self.check_found()
+
+    async def check_found(self) -> None:
+        """Keep the found URLs which aren't stored yet, or were modified after
+        they were last fetched."""
+        found = self.found
+        self.found = {}
+        if not len(found):
+            return
+        stmt = select(page_table.c.url, page_table.c.timestamp)
+        stmt = stmt.where(page_table.c.url.in_(list(found.keys())))
+        async with db_connect() as conn:
+            result = await conn.execute(stmt)
+            stored = {row.url: row.timestamp for row in result.fetchall()}
+        for url, date in found.items():
+            if url not in stored:
+                self.urls.append(URL(url))
+            elif date is not None and date > stored[url]:
+                self.urls.append(URL(url))
+                self.updated.add(URL(url))
+
+    async def run(self) -> List[URL]:
+        stmt = select(func.max(page_table.c.timestamp))
+        stmt = stmt.where(page_table.c.site == self.name)
+        async with db_connect() as conn:
+            result = await conn.execute(stmt)
+            self.since = result.scalar()
+
+        queue = [u.url for u in self.site.config.feeds]
+        if self.site.config.robots:
+            queue.extend(await self.robots_sitemaps())
+        while len(queue) and len(self.fetched) < MAX_SITEMAPS:
+            url = queue.pop(0)
+            if url in self.fetched:
+                continue
+            queue.extend(await self.read(url))
+        await self.check_found()
+        log.info(
+            "Discovered [%s]: %d new or updated pages in %d sitemaps and feeds",
+            self.name,
+            len(self.urls),
+            len(self.fetched),
+        )
+        return self.urls
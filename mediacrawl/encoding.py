@@ -0,0 +1,79 @@
+import re
+import codecs
+from typing import Generator, Optional, Tuple
+from charset_normalizer import from_bytes
+
+# How much of the page is searched for a <meta> charset declaration:
+META_BYTES = 1024 * 4
+# How much of the page is used for statistical charset detection:
+SAMPLE_BYTES = 1024 * 64
+
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+META_CHARSET = re.compile(rb"<meta[^>]*?charset\s*=\s*[\"']?\s*([\w.:+-]+)", re.I)
+
+
+def normalize_encoding(name: Optional[str]) -> Optional[str]:
+    if name is None:
+        return None
+    try:
+        return codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+
+
+def sniff_meta(content: bytes) -> Optional[str]:
+    match = META_CHARSET.search(content[:META_BYTES])
+    if match is None:
+        return None
+    encoding = normalize_encoding(match.group(1).decode("ascii"))
+    # A document which declares itself in ASCII can't be UTF-16/32:
+    if encoding is not None and encoding.startswith(("utf-16", "utf-32")):
+        return "utf-8"
+    return encoding
+
+
+def iter_encodings(
+    content: bytes, *declared: Optional[str]
+) -> Generator[str, None, None]:
+    """Generate candidate encodings for the content, cheapest evidence first:
+    a byte order mark, the given declared encodings (e.g. from the HTTP header),
+    a <meta> tag at the start of the document, plain UTF-8 and finally a
+    statistical guess based on a sample of the content."""
+    for bom, encoding in BOMS:
+        if content.startswith(bom):
+            yield encoding
+            return
+    for name in declared:
+        encoding = normalize_encoding(name)
+        if encoding is not None:
+            yield encoding
+    encoding = sniff_meta(content)
+    if encoding is not None:
+        yield encoding
+    yield "utf-8"
+    match = from_bytes(content[:SAMPLE_BYTES]).best()
+    if match is not None and match.encoding is not None:
+        yield match.encoding
+
+
+def decode_content(
+    content: bytes, *declared: Optional[str]
+) -> Tuple[Optional[str], Optional[str]]:
+    """Decode the content with the first candidate encoding which fits it.
+    Returns the encoding used and the text, or `None` for both."""
+    tried = set()
+    for encoding in iter_encodings(content, *declared):
+        if encoding in tried:
+            continue
+        tried.add(encoding)
+        try:
+            return encoding, content.decode(encoding, "strict")
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return None, None
@@ -0,0 +1,216 @@
+import gzip
+import orjson
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import IO, Any, Dict, List, Optional, Tuple
+from zstandard import ZstdCompressor
+from articledata import Article
+
+JSONL = "jsonl"
+JSONL_GZIP = "jsonl.gz"
+JSONL_ZSTD = "jsonl.zst"
+PARQUET = "parquet"
+ARROW = "arrow"
+FORMATS = [JSONL, JSONL_GZIP, JSONL_ZSTD, PARQUET, ARROW]
+# Formats whose output can be added to by a later run:
+APPEND_FORMATS = [JSONL, JSONL_GZIP, JSONL_ZSTD]
+ROTATE_SIZE = 1024 * 1024 * 256
+# Number of articles in each Parquet row group or Arrow record batch:
+BATCH_ROWS = 5000
+
+
+def article_row(article: Article) -> Dict[str, Any]:
+    data = article.dict()
+    data["url"] = article.url.url
+    return data
+
+
+class Exporter(ABC):
+    """Write the articles of one site to the output directory."""
+
+    def __init__(self, outpath: Path, site: str) -> None:
+        self.outpath = outpath
+        self.site = site
+
+    @abstractmethod
+    def write(self, articles: List[Article]) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class JsonExporter(Exporter):
+    """Write articles as JSON lines, to a single `{site}.ijson` file."""
+
+    def __init__(
+        self, outpath: Path, site: str, suffix: str = ".ijson", append: bool = False
+    ) -> None:
+        super().__init__(outpath, site)
+        self.fh = open(outpath.joinpath(f"{site}{suffix}"), "ab" if append else "wb")
+
+    def write(self, articles: List[Article]) -> None:
+        for article in articles:
+            data = article_row(article)
+            self.fh.write(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE))
+
+    def flush(self) -> None:
+        self.fh.flush()
+
+    def close(self) -> None:
+        self.fh.close()
+
+
+class CompressedJsonExporter(Exporter):
+    """Write articles as compressed JSON lines, starting a new numbered file
+    (`{site}-00001.ijson.gz`, ...) once `rotate_size` bytes of JSON have been
+    written to the current one. When appending, numbering continues after the
+    files already in the output directory; otherwise they are deleted, so that
+    no articles from an earlier run are left among the new files."""
+
+    def __init__(
+        self,
+        outpath: Path,
+        site: str,
+        format: str,
+        rotate_size: int = ROTATE_SIZE,
+        append: bool = False,
+    ) -> None:
+        super().__init__(outpath, site)
+        self.format = format
+        self.extension = format.split(".", 1)[-1]
+        self.rotate_size = rotate_size
+        self.shard = 0
+        for number, path in self.existing():
+            if append:
+                self.shard = max(self.shard, number)
+            else:
+                path.unlink()
+        self.size = 0
+        self.fh: Optional[IO[bytes]] = None
+
+    def existing(self) -> List[Tuple[int, Path]]:
+        """List the numbered files of the site in the output directory, in
+        either compression format."""
+        files: List[Tuple[int, Path]] = []
+        for path in self.outpath.glob(f"{self.site}-*.ijson.*"):
+            number, _, extension = path.name[len(self.site) + 1 :].partition(".")
+            if number.isdigit() and extension in ("ijson.gz", "ijson.zst"):
+                files.append((int(number), path))
+        return files
+
+    def open(self) -> IO[bytes]:
+        self.shard += 1
+        self.size = 0
+        name = f"{self.site}-{self.shard:05d}.ijson.{self.extension}"
+        path = self.outpath.joinpath(name)
+        if self.format == JSONL_GZIP:
+            return gzip.open(path, "wb", compresslevel=6)
+        return ZstdCompressor(level=3).stream_writer(open(path, "wb"))
+
+    def write(self, articles: List[Article]) -> None:
+        for article in articles:
+            if self.fh is None or self.size >= self.rotate_size:
+                self.close()
+                self.fh = self.open()
+            data = article_row(article)
+            line = orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+            self.fh.write(line)
+            self.size += len(line)
+
+    def close(self) -> None:
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+class ArrowExporter(Exporter):
+    """Write articles to a Parquet or Arrow IPC file, in batches of `BATCH_ROWS`
+    articles. Both store each field as a column, so that readers can load the
+    titles, dates or languages without reading the article texts."""
+
+    def __init__(self, outpath: Path, site: str, format: str) -> None:
+        super().__init__(outpath, site)
+        try:
+            import pyarrow
+        except ImportError:
+            raise RuntimeError("Install pyarrow to export %s files" % format)
+        self.pa = pyarrow
+        self.format = format
+        self.path = outpath.joinpath(f"{site}.{format}")
+        string = pyarrow.string()
+        self.schema = pyarrow.schema(
+            [
+                ("id", string),
+                ("url", string),
+                ("site", string),
+                ("title", string),
+                ("section", string),
+                ("date", string),
+                ("language", string),
+                ("locale", string),
+                ("tags", pyarrow.list_(string)),
+                ("bylines", pyarrow.list_(string)),
+                ("description", string),
+                ("lede", string),
+                ("text", string),
+                ("extracted_at", string),
+            ]
+        )
+        self.writer: Any = None
+        self.rows: List[Dict[str, Any]] = []
+
+    def open(self) -> Any:
+        if self.format == PARQUET:
+            import pyarrow.parquet
+
+            return pyarrow.parquet.ParquetWriter(
+                self.path, self.schema, compression="zstd"
+            )
+        return self.pa.ipc.new_file(self.path, self.schema)
+
+    def write(self, articles: List[Article]) -> None:
+        self.rows.extend(article_row(a) for a in articles)
+        if len(self.rows) >= BATCH_ROWS:
+            self.flush()
+
+    def flush(self) -> None:
+        if not len(self.rows):
+            return
+        if self.writer is None:
+            self.writer = self.open()
+        batch = self.pa.RecordBatch.from_pylist(self.rows, schema=self.schema)
+        self.rows = []
+        if self.format == PARQUET:
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+
+    def close(self) -> None:
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def create_exporter(
+    outpath: Path,
+    site: str,
+    format: str = JSONL,
+    rotate_size: int = ROTATE_SIZE,
+    append: bool = False,
+) -> Exporter:
+    if append and format not in APPEND_FORMATS:
+        raise ValueError("Cannot append to %s files" % format)
+    if format == JSONL:
+        return JsonExporter(outpath, site, append=append)
+    if format in (JSONL_GZIP, JSONL_ZSTD):
+        return CompressedJsonExporter(
+            outpath, site, format, rotate_size=rotate_size, append=append
+        )
+    if format in (PARQUET, ARROW):
+        return ArrowExporter(outpath, site, format)
+    raise ValueError("Unknown export format: %r" % format)
@@ -0,0 +1,208 @@
+import logging
+from hashlib import sha1
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+from sqlalchemy import delete, func, update
+from sqlalchemy.future import select
+from articledata import URL
+
+from mediacrawl.db import Conn, frontier_table, upsert
+
+QUEUED = "queued"
+ACTIVE = "active"
+DONE = "done"
+# URLs which could not be fetched in all the attempts made:
+FAILED = "failed"
+OPEN = [QUEUED, ACTIVE]
+# Where a URL was found: a seed in the configuration, a link on a crawled
+# page, or a sitemap or feed:
+SEED = "seed"
+LINK = "link"
+SITEMAP = "sitemap"
+CHUNK = 500
+
+# A claimed URL, with its site, depth and source:
+Claim = Tuple[str, URL, int, str]
+log = logging.getLogger(__name__)
+
+
+def host_hash(url: URL) -> int:
+    """A stable hash of the URL's host, used to split the frontier into shards.
+    Kept to 28 bits so it fits an integer column on all databases."""
+    return int(sha1(url.domain.encode("utf-8")).hexdigest()[:7], 16)
+
+
+class Frontier(object):
+    """The set of URLs a crawl has discovered, stored in the database so that an
+    interrupted crawl can pick up where it stopped. Newly discovered and completed
+    URLs are buffered in memory and written out in batches by `flush`, the new
+    URLs first, so that a URL is never done before the links found on it are
+    stored. Fetched pages are completed by the page writer once saved. URLs
+    which failed to be fetched are kept when the crawl is done, and retried by
+    the next crawl of the site.
+
+    Each URL is stored with its link depth from the seeds, how it was found
+    and a priority, and queued URLs are claimed highest priority first.
+
+    Several crawlers can share a frontier by each taking one shard of it: the
+    URLs are split by the hash of their host, so that all requests to a host
+    are made by the same crawler."""
+
+    def __init__(self, shard: Optional[Tuple[int, int]] = None) -> None:
+        self.sites: List[str] = []
+        self.shard = shard
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.completed: List[str] = []
+        self.failed: List[Dict[str, Any]] = []
+
+    def in_shard(self, stmt: Any) -> Any:
+        """Limit a query to the rows of the crawler's own shard, if any."""
+        if self.shard is None:
+            return stmt
+        index, count = self.shard
+        shard = func.coalesce(frontier_table.c.host_hash, 0) % count
+        return stmt.where(shard == index)
+
+    async def resume(self, conn: Conn, site: str) -> bool:
+        """Prepare the frontier of a site for crawling. Returns `True` if an
+        unfinished crawl was found and will be continued."""
+        self.sites.append(site)
+        stmt = select(func.count()).select_from(frontier_table)
+        stmt = stmt.where(frontier_table.c.site == site)
+        stmt = stmt.where(frontier_table.c.state.in_(OPEN))
+        result = await conn.execute(stmt)
+        if not result.scalar():
+            dstmt = delete(frontier_table)
+            dstmt = dstmt.where(frontier_table.c.site == site)
+            dstmt = dstmt.where(frontier_table.c.state != FAILED)
+            await conn.execute(dstmt)
+            ustmt = update(frontier_table)
+            ustmt = ustmt.where(frontier_table.c.site == site)
+            ustmt = ustmt.values({"state": QUEUED, "attempts": None, "error": None})
+            result = await conn.execute(ustmt)
+            if result.rowcount:
+                log.info("Retrying %d failed URLs: %s", result.rowcount, site)
+            return False
+
+        # Pages which were being fetched when the crawl stopped go back
+        # into the queue (other shards are reset by their own crawler):
+        ustmt = update(frontier_table)
+        ustmt = ustmt.where(frontier_table.c.site == site)
+        ustmt = ustmt.where(frontier_table.c.state == ACTIVE)
+        ustmt = self.in_shard(ustmt)
+        ustmt = ustmt.values({"state": QUEUED})
+        await conn.execute(ustmt)
+        return True
+
+    async def iter_urls(self, conn: Conn, site: str) -> AsyncGenerator[URL, None]:
+        stmt = select(frontier_table.c.url)
+        stmt = stmt.where(frontier_table.c.site == site)
+        result = await conn.stream(stmt)
+        async for row in result:
+            yield URL(row.url)
+
+    def push(
+        self,
+        site: str,
+        url: URL,
+        depth: int = 0,
+        source: str = LINK,
+        priority: int = 0,
+    ) -> None:
+        self.pending[url.url] = {
+            "site": site,
+            "url": url.url,
+            "host_hash": host_hash(url),
+            "depth": depth,
+            "source": source,
+            "priority": priority,
+        }
+
+    def stop(self, site: str) -> None:
+        """Stop claiming URLs of a site, e.g. when its crawl budget is used up.
+        Its queued URLs are kept for the next crawl."""
+        if site in self.sites:
+            self.sites.remove(site)
+
+    def complete(self, url: URL) -> None:
+        self.completed.append(url.url)
+
+    def fail(self, url: URL, attempts: int, error: Optional[str]) -> None:
+        self.failed.append({"url": url.url, "attempts": attempts, "error": error})
+
+    async def flush(self, conn: Conn) -> None:
+        pending = list(self.pending.values())
+        self.pending = {}
+        now = datetime.utcnow()
+        for i in range(0, len(pending), CHUNK):
+            rows = [
+                dict(row, state=QUEUED, timestamp=now) for row in pending[i : i + CHUNK]
+            ]
+            istmt = upsert(frontier_table).values(rows)
+            istmt = istmt.on_conflict_do_nothing(index_elements=["url"])
+            await conn.execute(istmt)
+
+        completed = self.completed
+        self.completed = []
+        for i in range(0, len(completed), CHUNK):
+            ustmt = update(frontier_table)
+            ustmt = ustmt.where(frontier_table.c.url.in_(completed[i : i + CHUNK]))
+            ustmt = ustmt.values({"state": DONE, "timestamp": now})
+            await conn.execute(ustmt)
+
+        failed = self.failed
+        self.failed = []
+        for item in failed:
+            ustmt = update(frontier_table)
+            ustmt = ustmt.where(frontier_table.c.url == item["url"])
+            ustmt = ustmt.values(
+                {
+                    "state": FAILED,
+                    "attempts": item["attempts"],
+                    "error": item["error"],
+                    "timestamp": now,
+                }
+            )
+            await conn.execute(ustmt)
+
+    async def claim(self, conn: Conn, limit: int) -> List[Claim]:
+        """Fetch a batch of queued URLs, highest priority first, and mark them
+        as being crawled. The batch is shared out between the sites, so that
+        one site's high-priority URLs don't hold up the others. Rows locked by
+        another crawler's claim are skipped rather than waited for."""
+        claimed: List[Claim] = []
+        per_site = max(1, limit // max(1, len(self.sites)))
+        # Sites may be stopped while this runs:
+        for site in list(self.sites):
+            stmt = select(
+                frontier_table.c.url,
+                frontier_table.c.depth,
+                frontier_table.c.source,
+            )
+            stmt = stmt.where(frontier_table.c.state == QUEUED)
+            stmt = stmt.where(frontier_table.c.site == site)
+            stmt = self.in_shard(stmt)
+            stmt = stmt.order_by(frontier_table.c.priority.desc().nullslast())
+            stmt = stmt.limit(per_site)
+            stmt = stmt.with_for_update(skip_locked=True)
+            result = await conn.execute(stmt)
+            rows = result.fetchall()
+            if not len(rows):
+                continue
+            for row in rows:
+                claimed.append((site, URL(row.url), row.depth or 0, row.source or LINK))
+            ustmt = update(frontier_table)
+            ustmt = ustmt.where(frontier_table.c.url.in_([r.url for r in rows]))
+            ustmt = ustmt.values({"state": ACTIVE})
+            await conn.execute(ustmt)
+        return claimed
+
+    async def count_open(self, conn: Conn) -> int:
+        """Count the URLs of the crawled sites which are queued or being crawled,
+        in all shards: a crawler may still be handed new URLs while another one
+        is working."""
+        stmt = select(func.count()).select_from(frontier_table)
+        stmt = stmt.where(frontier_table.c.site.in_(self.sites))
+        stmt = stmt.where(frontier_table.c.state.in_(OPEN))
+        result = await conn.execute(stmt)
+        return result.scalar() or 0
@@ -1,11 +1,13 @@
 from functools import cache
-from typing import Optional
+from typing import Dict, List, Optional
 import fasttext
 import languagecodes
 from normality import collapse_spaces
 from pathlib import Path
 
 model_path = Path(__file__).parent / "models/lid.176.ftz"
+# Number of characters of a text used to identify its language:
+MAX_CHARS = 10000
 
 
 @cache
@@ -18,17 +20,44 @@ def get_model():
     return fasttext.load_model(model_path.as_posix())
 
 
-def detect_language(text: Optional[str]) -> Optional[str]:
-    model = get_model()
-    text = collapse_spaces(text)
+def prepare_text(text: Optional[str]) -> Optional[str]:
+    """Collapse the whitespace in the leading part of the text, as much as is
+    needed to get `MAX_CHARS` characters for the language model."""
     if text is None:
-        return text
-    out = model.predict(text[:10000])
-    if not len(out):
         return None
-    ((lang,), _) = out
-    lang = lang.replace("__label__", "")
-    lang_long = languagecodes.iso_639_alpha3(lang)
-    if lang_long is not None:
-        return lang_long
-    return None
+    end = MAX_CHARS
+    while True:
+        collapsed = collapse_spaces(text[:end])
+        if collapsed is None or len(collapsed) >= MAX_CHARS or end >= len(text):
+            break
+        end *= 2
+    if collapsed is None:
+        return None
+    return collapsed[:MAX_CHARS]
+
+
+def detect_languages(
+    texts: List[Optional[str]], threshold: float = 0.0
+) -> List[Optional[str]]:
+    """Identify the language of each of the texts, as ISO 639-3 codes, in a
+    single call to the model. Predictions with a lower confidence than the
+    threshold are returned as `None`."""
+    prepared = [prepare_text(t) for t in texts]
+    unique: Dict[str, Optional[str]] = {}
+    for text in prepared:
+        if text is not None:
+            unique[text] = None
+    if len(unique):
+        model = get_model()
+        inputs = list(unique.keys())
+        labels, _ = model.predict(inputs, k=1, threshold=threshold)
+        for text, label in zip(inputs, labels):
+            if not len(label):
+                continue
+            lang = label[0].replace("__label__", "")
+            unique[text] = languagecodes.iso_639_alpha3(lang)
+    return [None if t is None else unique[t] for t in prepared]
+
+
+def detect_language(text: Optional[str], threshold: float = 0.0) -> Optional[str]:
+    return detect_languages([text], threshold=threshold)[0]
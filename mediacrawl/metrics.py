@@ -0,0 +1,158 @@
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+from aiohttp import web
+
+Labels = Tuple[Tuple[str, str], ...]
+
+INTERVAL = 30.0
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS = {
+    "fetches": ("counter", "Pages fetched, by HTTP status"),
+    "cache_hits": ("counter", "Pages handled from the database"),
+    "discovered": ("counter", "New or updated pages found in sitemaps and feeds"),
+    "rejected": ("counter", "Pages or links rejected by the crawl rules"),
+    "bytes": ("counter", "Bytes of page content downloaded"),
+    "errors": ("counter", "Failed fetches, by exception type"),
+    "retries": ("counter", "Failed fetches scheduled to be made again"),
+    "failures": ("counter", "URLs given up on after all their attempts"),
+    "pages_written": ("counter", "Pages stored by the page writer"),
+    "articles": ("counter", "Articles extracted while crawling, with --parse"),
+    "fetch_seconds": ("histogram", "Time from request to last byte of a page"),
+    "host_wait_seconds": ("histogram", "Time a task waited for its host"),
+    "db_write_seconds": ("histogram", "Time taken to store a batch of pages"),
+    "queued": ("gauge", "New tasks waiting for a worker"),
+    "deferred": ("gauge", "Tasks waiting for their host to be available"),
+    "retrying": ("gauge", "Failed tasks waiting to be retried"),
+    "active": ("gauge", "Tasks being worked on"),
+    "write_pending": ("gauge", "Pages waiting to be stored"),
+    "parse_pending": ("gauge", "Pages waiting to be parsed, with --parse"),
+}
+
+log = logging.getLogger(__name__)
+
+
+def format_labels(labels: Labels) -> str:
+    if not len(labels):
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{%s}" % ",".join(pairs)
+
+
+class Histogram(object):
+    def __init__(self) -> None:
+        self.counts = [0 for _ in BUCKETS]
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """Counters and timings of a crawl, labelled by site. They can be served in
+    the Prometheus text format and are summarised in the log periodically."""
+
+    def __init__(self) -> None:
+        self.counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.started = time.monotonic()
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    def gauge(self, name: str, func: Callable[[], float]) -> None:
+        self.gauges[name] = func
+
+    def total(self, name: str, site: Optional[str] = None) -> float:
+        value = 0.0
+        for (key, labels), count in self.counters.items():
+            if key == name and (site is None or ("site", site) in labels):
+                value += count
+        return value
+
+    def render(self) -> str:
+        """Format all metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for name, (type_, help) in METRICS.items():
+            full_name = f"mediacrawl_{name}"
+            if type_ == "counter":
+                full_name = f"{full_name}_total"
+            lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {type_}")
+            if type_ == "gauge" and name in self.gauges:
+                lines.append(f"{full_name} {self.gauges[name]()}")
+            for (key, labels), value in sorted(self.counters.items()):
+                if key == name:
+                    lines.append(f"{full_name}{format_labels(labels)} {value}")
+            for (key, labels), hist in sorted(self.histograms.items()):
+                if key != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS, hist.counts):
+                    cumulative += count
+                    le = format_labels(labels + (("le", str(bound)),))
+                    lines.append(f"{full_name}_bucket{le} {cumulative}")
+                le = format_labels(labels + (("le", "+Inf"),))
+                lines.append(f"{full_name}_bucket{le} {hist.count}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {hist.sum}")
+                lines.append(f"{full_name}_count{format_labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def summarize(self) -> None:
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        sites = set()
+        for _, labels in self.counters.keys():
+            sites.update(v for k, v in labels if k == "site")
+        for site in sorted(sites):
+            fetches = self.total("fetches", site)
+            log.info(
+                "Stats [%s]: %d fetched (%.1f/s), %d cached, %d rejected, "
+                "%.1f MB, %d errors",
+                site,
+                fetches,
+                fetches / elapsed,
+                self.total("cache_hits", site),
+                self.total("rejected", site),
+                self.total("bytes", site) / (1024 * 1024),
+                self.total("errors", site),
+            )
+        gauges = ", ".join(f"{n} {f():.0f}" for n, f in self.gauges.items())
+        log.info("Stats: %s", gauges)
+
+    async def report(self, interval: float = INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.summarize()
+
+    async def serve(self, port: int) -> web.AppRunner:
+        """Serve the metrics at `/metrics` on the given local port."""
+
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", port)
+        await site.start()
+        log.info("Serving metrics: http://127.0.0.1:%d/metrics", port)
+        return runner
@@ -1,15 +1,39 @@
+import orjson
+from hashlib import sha1
 from lxml import html, etree
 from datetime import datetime
 from functools import cached_property
-from typing import AsyncGenerator, List, Optional
+from typing import Any, AsyncGenerator, Callable, Dict, Iterable, List, Optional, Set
 from pydantic import BaseModel, validator
-from charset_normalizer import from_bytes
 from aiohttp import ClientResponse
-from sqlalchemy import or_
+from sqlalchemy import and_, or_, func, tuple_
 from sqlalchemy.future import select
+from sqlalchemy.sql import ColumnElement, Select
 from articledata import URL
 
-from mediacrawl.db import Conn, page_table, upsert
+from mediacrawl.codec import compress, decompress
+from mediacrawl.encoding import decode_content
+from mediacrawl.mime import WEB
+from mediacrawl.db import Conn, body_table, link_table, page_table, parsed_table
+from mediacrawl.db import upsert
+
+# Number of pages read per query when scanning pages for parsing, and
+# number of those whose bodies are loaded at once:
+SCAN_SIZE = 1000
+CONTENT_SIZE = 100
+# The response headers stored with a page, needed to re-fetch it conditionally.
+# Others, such as cookies, are dropped:
+VALIDATORS = ("etag", "last-modified")
+
+
+def row_content(data: Dict[str, Any]) -> Optional[bytes]:
+    """Pop the stored body columns from a row and return the page content."""
+    codec = data.pop("codec", None)
+    body_codec = data.pop("body_codec", None)
+    body_content = data.pop("body_content", None)
+    if body_content is not None:
+        return decompress(body_codec, body_content)
+    return decompress(codec, data.pop("content", None))
 
 
 class Page(BaseModel):
@@ -21,9 +45,14 @@ class Page(BaseModel):
     retrieved: bool = False
     status: Optional[int] = None
     timestamp: datetime
+    headers: Dict[str, str] = {}
     content_type: Optional[str] = None
     charset: Optional[str] = None
+    encoding: Optional[str] = None
+    content_hash: Optional[str] = None
     content: Optional[bytes] = None
+    outlinks: Optional[int] = None
+    links: Optional[List[URL]] = None
 
     @cached_property
     def text(self) -> Optional[str]:
@@ -31,20 +60,12 @@ class Page(BaseModel):
             return None
         if len(self.content) < 100:
             return None
-        res = from_bytes(self.content)
-        match = res.best()
-        if match is not None and match.encoding is not None:
-            try:
-                return self.content.decode(match.encoding, "strict")
-            except UnicodeDecodeError:
-                pass
-        if self.charset is not None:
-            try:
-                return self.content.decode(self.charset, "strict")
-            except UnicodeDecodeError:
-                pass
+        # The encoding found when the page was first decoded is stored, so that
+        # it is tried first later on:
+        encoding, text = decode_content(self.content, self.encoding, self.charset)
+        self.encoding = encoding
         # return self.content.decode('utf-8', 'replace')
-        return None
+        return text
 
     @cached_property
     def doc(self) -> Optional[etree._Element]:
@@ -66,9 +87,36 @@ class Page(BaseModel):
             return None
         return URL(url)
 
+    @validator("headers", pre=True)
+    def convert_headers(cls, headers: Any) -> Any:
+        if headers is None:
+            return {}
+        if isinstance(headers, str):
+            return orjson.loads(headers)
+        return headers
+
+    @property
+    def validators(self) -> Dict[str, str]:
+        """Request headers to re-fetch the page only if it has been modified."""
+        headers: Dict[str, str] = {}
+        etag = self.headers.get("etag")
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        modified = self.headers.get("last-modified")
+        if modified is not None:
+            headers["If-Modified-Since"] = modified
+        return headers
+
     class Config:
         keep_untouched = (cached_property,)
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # The parsed document can't be pickled, e.g. to send the page to a
+        # worker process, but the decoded text is kept:
+        state = super().__getstate__()
+        state["__dict__"] = {k: v for k, v in state["__dict__"].items() if k != "doc"}
+        return state
+
     @classmethod
     def from_response(
         cls, site: str, original_url: URL, resp: ClientResponse
@@ -80,14 +128,41 @@ class Page(BaseModel):
             method=resp.method,
             ok=resp.ok,
             status=resp.status,
+            headers={k: resp.headers[k] for k in VALIDATORS if k in resp.headers},
             content_type=resp.content_type,
             charset=resp.charset,
             timestamp=datetime.utcnow(),
         )
 
     @classmethod
-    async def find(cls, conn: Conn, url: URL) -> Optional["Page"]:
-        stmt = select(page_table)
+    def query(cls, content: bool = True) -> Select:
+        """Query pages along with their body, which is either stored by content
+        hash in the body table or (for older rows) inline."""
+        if not content:
+            skip = ("codec", "content")
+            return select(*[c for c in page_table.c if c.name not in skip])
+        join = page_table.outerjoin(
+            body_table, page_table.c.content_hash == body_table.c.hash
+        )
+        stmt = select(
+            page_table,
+            body_table.c.codec.label("body_codec"),
+            body_table.c.content.label("body_content"),
+        )
+        return stmt.select_from(join)
+
+    @classmethod
+    def from_row(cls, row: Any) -> "Page":
+        data = dict(row._mapping)
+        has_content = "content" in data
+        data["content"] = row_content(data)
+        page = cls.parse_obj(data)
+        page.retrieved = has_content
+        return page
+
+    @classmethod
+    async def find(cls, conn: Conn, url: URL, content: bool = True) -> Optional["Page"]:
+        stmt = cls.query(content=content)
         clause = or_(
             page_table.c.url == url.url,
             page_table.c.original_url == url.url,
@@ -96,40 +171,257 @@ class Page(BaseModel):
         stmt = stmt.limit(1)
         resp = await conn.execute(stmt)
         for row in resp.fetchall():
-            page = cls.parse_obj(row)
-            page.retrieved = True
-            return page
+            return cls.from_row(row)
         return None
 
+    @classmethod
+    async def sample_content(cls, conn: Conn, site: str, limit: int) -> List[bytes]:
+        stmt = cls.query()
+        stmt = stmt.where(page_table.c.site == site)
+        stmt = stmt.where(page_table.c.ok == True)
+        stmt = stmt.order_by(page_table.c.timestamp.desc())
+        stmt = stmt.limit(limit)
+        result = await conn.execute(stmt)
+        samples: Dict[Optional[str], bytes] = {}
+        for row in result.fetchall():
+            page = cls.from_row(row)
+            if page.content is not None:
+                samples[page.content_hash or page.url.url] = page.content
+        return list(samples.values())
+
     @classmethod
     async def iter_parse(
-        cls, conn: Conn, sites: List[str] = []
+        cls,
+        conn: Conn,
+        sites: List[str] = [],
+        by_content: bool = False,
+        incremental: bool = False,
+        where: Optional[ColumnElement] = None,
+        accept: Optional[Callable[["Page"], bool]] = None,
+        after: Optional[str] = None,
+        until: Optional[str] = None,
     ) -> AsyncGenerator["Page", None]:
-        stmt = select(page_table)
+        """Generate the web pages to be parsed. Pages are scanned without their
+        bodies, using keyset pagination on the URL (or on the content hash and
+        URL), and filtered by the SQL condition `where` and then the `accept`
+        function. Only the pages which pass have their body loaded. `after` and
+        `until` limit the scan to a range of URLs, so that it can be split up
+        or resumed."""
+        stmt = cls.query(content=False)
         stmt = stmt.where(page_table.c.ok == True)
+        stmt = stmt.where(page_table.c.content_type.in_(WEB))
         if len(sites):
             stmt = stmt.where(page_table.c.site.in_(sites))
-        result = await conn.stream(stmt)
-        async for row in result:
-            page = cls.parse_obj(row)
+        if where is not None:
+            stmt = stmt.where(where)
+        if after is not None:
+            stmt = stmt.where(page_table.c.url > after)
+        if until is not None:
+            stmt = stmt.where(page_table.c.url <= until)
+        if incremental:
+            # Skip pages which have not changed since they were last parsed:
+            stmt = stmt.outerjoin(parsed_table, page_table.c.url == parsed_table.c.url)
+            unhashed = or_(
+                page_table.c.content_hash == None,
+                parsed_table.c.content_hash == None,
+            )
+            changed = or_(
+                parsed_table.c.url == None,
+                page_table.c.content_hash != parsed_table.c.content_hash,
+                and_(unhashed, page_table.c.timestamp > parsed_table.c.timestamp),
+            )
+            stmt = stmt.where(changed)
+        keys = [page_table.c.url]
+        if by_content:
+            keys.insert(0, func.coalesce(page_table.c.content_hash, ""))
+        stmt = stmt.order_by(*keys).limit(SCAN_SIZE)
+        last: Optional[List[str]] = None
+        while True:
+            query = stmt
+            if last is not None:
+                query = query.where(tuple_(*keys) > tuple_(*last))
+            result = await conn.execute(query)
+            rows = result.fetchall()
+            if not len(rows):
+                break
+            mapping = rows[-1]._mapping
+            last = [mapping["url"]]
+            if by_content:
+                last.insert(0, mapping["content_hash"] or "")
+            pages: Dict[str, Page] = {}
+            for row in rows:
+                page = cls.from_row(row)
+                if accept is None or accept(page):
+                    pages[row._mapping["url"]] = page
+                if len(pages) >= CONTENT_SIZE:
+                    await cls.load_content(conn, pages)
+                    for page in pages.values():
+                        yield page
+                    pages = {}
+            if len(pages):
+                await cls.load_content(conn, pages)
+                for page in pages.values():
+                    yield page
+
+    @classmethod
+    async def load_content(cls, conn: Conn, pages: Dict[str, "Page"]) -> None:
+        """Load the bodies of pages which were queried without them, given by
+        their stored URL."""
+        join = page_table.outerjoin(
+            body_table, page_table.c.content_hash == body_table.c.hash
+        )
+        stmt = select(
+            page_table.c.url,
+            page_table.c.codec,
+            page_table.c.content,
+            body_table.c.codec.label("body_codec"),
+            body_table.c.content.label("body_content"),
+        )
+        stmt = stmt.select_from(join)
+        stmt = stmt.where(page_table.c.url.in_(list(pages.keys())))
+        result = await conn.execute(stmt)
+        for row in result.fetchall():
+            data = dict(row._mapping)
+            page = pages[data["url"]]
+            page.content = row_content(data)
             page.retrieved = True
-            yield page
 
-    async def save(self, conn: Conn) -> None:
-        data = self.dict(exclude={"retrieved", "doc", "url", "original_url", "text"})
+    @classmethod
+    async def find_parsed(cls, conn: Conn, urls: List[str]) -> Dict[str, Optional[str]]:
+        """Find which of the given pages were parsed before, along with the
+        content hash they were last parsed with."""
+        parsed: Dict[str, Optional[str]] = {}
+        for i in range(0, len(urls), 1000):
+            stmt = select(parsed_table.c.url, parsed_table.c.content_hash)
+            stmt = stmt.where(parsed_table.c.url.in_(urls[i : i + 1000]))
+            result = await conn.execute(stmt)
+            for row in result.fetchall():
+                parsed[row.url] = row.content_hash
+        return parsed
+
+    @classmethod
+    async def find_parsed_sites(cls, conn: Conn, sites: Iterable[str]) -> Set[str]:
+        """Find which of the given sites have any recorded parse state."""
+        stmt = select(parsed_table.c.site).distinct()
+        stmt = stmt.where(parsed_table.c.site.in_(list(sites)))
+        result = await conn.execute(stmt)
+        return set(row.site for row in result.fetchall())
+
+    @classmethod
+    async def save_parsed(cls, conn: Conn, pages: List[Dict[str, Any]]) -> None:
+        """Record the state in which pages were parsed, so that incremental runs
+        of the parser can skip them until they change."""
+        for i in range(0, len(pages), 1000):
+            istmt = upsert(parsed_table).values(pages[i : i + 1000])
+            values = dict(
+                content_hash=istmt.excluded.content_hash,
+                timestamp=istmt.excluded.timestamp,
+            )
+            stmt = istmt.on_conflict_do_update(index_elements=["url"], set_=values)
+            await conn.execute(stmt)
+
+    @property
+    def parsed_state(self) -> Dict[str, Any]:
+        return {
+            "url": self.url.url,
+            "site": self.site,
+            "content_hash": self.content_hash,
+            "timestamp": self.timestamp,
+        }
+
+    @classmethod
+    async def find_links(cls, conn: Conn, url: URL) -> List[URL]:
+        """Get the links which were stored for the page when it was fetched."""
+        stmt = select(link_table.c.target)
+        stmt = stmt.where(link_table.c.source == url.url)
+        result = await conn.execute(stmt)
+        return [URL(r.target) for r in result.fetchall()]
+
+    @classmethod
+    async def save_links(cls, conn: Conn, pages: List["Page"]) -> None:
+        """Replace the stored links of all pages whose links were extracted."""
+        links: Dict[str, List[URL]] = {}
+        for page in pages:
+            if page.links is not None:
+                links[page.url.url] = page.links
+        if not len(links):
+            return
+        sources = list(links.keys())
+        for i in range(0, len(sources), 1000):
+            stmt = link_table.delete()
+            stmt = stmt.where(link_table.c.source.in_(sources[i : i + 1000]))
+            await conn.execute(stmt)
+        rows = []
+        for source, targets in links.items():
+            for target in set(t.url for t in targets):
+                rows.append({"source": source, "target": target})
+        for i in range(0, len(rows), 1000):
+            istmt = upsert(link_table).values(rows[i : i + 1000])
+            istmt = istmt.on_conflict_do_nothing(index_elements=["source", "target"])
+            await conn.execute(istmt)
+
+    def to_row(self) -> Dict[str, Any]:
+        exclude = {"retrieved", "doc", "url", "original_url", "text", "content"}
+        exclude.add("links")
+        data = self.dict(exclude=exclude)
         data["url"] = self.url.url
         data["original_url"] = self.original_url.url
-        istmt = upsert(page_table).values([data])
+        data["headers"] = orjson.dumps(self.headers).decode("utf-8")
+        data["codec"] = None
+        data["content"] = None
+        if self.content is not None:
+            self.content_hash = sha1(self.content).hexdigest()
+        data["content_hash"] = self.content_hash
+        return data
+
+    async def save(self, conn: Conn) -> None:
+        await self.save_many(conn, [self])
+
+    @classmethod
+    async def save_bodies(cls, conn: Conn, pages: List["Page"]) -> None:
+        """Store the bodies of the given pages which are not already known
+        by their content hash."""
+        bodies = {p.content_hash: p for p in pages if p.content_hash is not None}
+        if not len(bodies):
+            return
+        stmt = select(body_table.c.hash)
+        stmt = stmt.where(body_table.c.hash.in_(list(bodies.keys())))
+        result = await conn.execute(stmt)
+        existing: Set[str] = set(r.hash for r in result.fetchall())
+        rows = []
+        for content_hash, page in bodies.items():
+            if content_hash in existing:
+                continue
+            codec, content = compress(page.site, page.content)
+            rows.append({"hash": content_hash, "codec": codec, "content": content})
+        if len(rows):
+            istmt = upsert(body_table).values(rows)
+            istmt = istmt.on_conflict_do_nothing(index_elements=["hash"])
+            await conn.execute(istmt)
+
+    @classmethod
+    async def save_many(cls, conn: Conn, pages: List["Page"]) -> None:
+        # A statement can only update each row once, so the last version of
+        # each URL wins:
+        rows = {p.url.url: p.to_row() for p in pages}
+        await cls.save_bodies(conn, pages)
+        istmt = upsert(page_table).values(list(rows.values()))
         values = dict(
             ok=istmt.excluded.ok,
             status=istmt.excluded.status,
+            headers=istmt.excluded.headers,
             content_type=istmt.excluded.content_type,
             charset=istmt.excluded.charset,
+            encoding=istmt.excluded.encoding,
+            content_hash=istmt.excluded.content_hash,
+            codec=istmt.excluded.codec,
             content=istmt.excluded.content,
+            outlinks=istmt.excluded.outlinks,
             timestamp=istmt.excluded.timestamp,
         )
         stmt = istmt.on_conflict_do_update(index_elements=["url"], set_=values)
         await conn.execute(stmt)
+        await cls.save_links(conn, pages)
 
     # async def update_parse(self, conn: Conn) -> None:
     #     stmt = update(page_table)
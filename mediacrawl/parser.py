@@ -1,22 +1,45 @@
 import orjson
+import shutil
+import asyncio
 import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
-from io import BufferedWriter
-from typing import Dict, List, Optional
-from articledata import Article
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from sqlalchemy import and_, or_, false
+from sqlalchemy.sql import ColumnElement
+from articledata import URL, Article
 from trafilatura import bare_extraction
 
+from mediacrawl.codec import load_dictionaries
 from mediacrawl.config import CrawlConfig, SiteConfig
-from mediacrawl.language import detect_language
+from mediacrawl.export import JSONL, ROTATE_SIZE, Exporter, JsonExporter
+from mediacrawl.export import create_exporter
+from mediacrawl.language import detect_languages
 from mediacrawl.page import Page
-from mediacrawl.db import engine
+from mediacrawl.rule import Check, compile_rules, rules_clause
+from mediacrawl.db import db_connect, engine, page_table
 
+BATCH_SIZE = 100
 log = logging.getLogger(__name__)
+# The parser used by each worker process when parsing with `--workers`:
+worker_parser: Optional["Parser"] = None
 
 
 class Parser(object):
-    def __init__(self, config: CrawlConfig):
+    def __init__(self, config: CrawlConfig, dedupe: bool = False):
         self.config = config
+        self.dedupe = dedupe
+        self.extracted: Optional[Tuple[str, Optional[Dict[str, Any]]]]
+        self.extracted = None
+        self.parse_rules: Dict[str, Optional[Check]] = {}
+        # Sites whose parse rules need the page body to be checked:
+        self.content_rules: Set[str] = set()
+        for site in config.sites:
+            self.parse_rules[site.name] = compile_rules(site.parse)
+            if site.parse is not None and site.parse.uses_content:
+                self.content_rules.add(site.name)
 
     def get_site_config(self, name: str) -> Optional[SiteConfig]:
         for site in self.config.sites:
@@ -25,17 +48,44 @@ class Parser(object):
         return None
 
     def check_parse(self, page: Page) -> bool:
-        config = self.get_site_config(page.site)
-        if config is None:
+        if page.site not in self.parse_rules:
             return False
-        if config.parse is None:
+        rules = self.parse_rules[page.site]
+        if rules is None:
             return True
-        if config.parse.check(page.url, page) is False:
+        if rules(page.url, page) is False:
             return False
         return True
 
-    async def parse(self, page: Page) -> Optional[Article]:
-        if not self.check_parse(page):
+    def check_scan(self, page: Page) -> bool:
+        """Check the parse rules of a page before its body is loaded, letting
+        through the pages of sites with rules on the page content."""
+        if page.site in self.content_rules:
+            return True
+        return self.check_parse(page)
+
+    @property
+    def scan_clause(self) -> ColumnElement:
+        """Select the pages of the configured sites which may match their parse
+        rules, as far as the rules can be expressed in SQL."""
+        clauses = []
+        for site in self.config.sites:
+            clause = page_table.c.site == site.name
+            rules = rules_clause(site.parse)
+            if rules is not None:
+                clause = and_(clause, rules)
+            clauses.append(clause)
+        if not len(clauses):
+            return false()
+        return or_(*clauses)
+
+    def prepare(
+        self, page: Page, check: bool = True
+    ) -> Optional[Tuple[Article, Optional[str]]]:
+        """Build the article for a page, returning it along with the text its
+        language is to be identified from. Unless `check` is off, pages which
+        don't match the parse rules are skipped."""
+        if check and not self.check_parse(page):
             return None
         log.info("Parsing: %r", page.url)
         article = Article(
@@ -52,9 +102,8 @@ class Parser(object):
         if page.text is None:
             return None
 
-        extract: Dict[str, str] = bare_extraction(
-            page.text, url=page.url.url, include_comments=False
-        )
+        extract = self.extract(page)
+        text: Optional[str] = None
         if extract is not None:
             article.title = extract.get("title", article.title)
             article.date = extract.get("date")
@@ -62,27 +111,189 @@ class Parser(object):
             author = extract.get("author")
             if author is not None:
                 article.bylines.append(author)
+            text = extract.get("text")
+        return article, text
+
+    async def parse(self, page: Page) -> Optional[Article]:
+        """Parse a single page. This stays a coroutine for existing callers;
+        the work itself is synchronous, see `parse_batch`."""
+        articles = self.parse_batch([page])
+        return articles[0] if len(articles) else None
+
+    def extract(self, page: Page) -> Optional[Dict[str, Any]]:
+        """Extract article metadata from the page. In dedupe mode, pages are
+        parsed in order of their content hash and the result for one body is
+        re-used for all the pages which share it."""
+        content_hash = page.content_hash
+        if self.dedupe and self.extracted is not None:
+            if content_hash is not None and self.extracted[0] == content_hash:
+                return self.extracted[1]
+
+        extract: Optional[Dict[str, Any]] = bare_extraction(
+            page.text, url=page.url.url, include_comments=False
+        )
+        if self.dedupe and content_hash is not None:
+            self.extracted = (content_hash, extract)
+        return extract
+
+    def parse_batch(self, pages: List[Page], check: bool = True) -> List[Article]:
+        """Parse a batch of pages, identifying the language of all the articles
+        in one go."""
+        prepared: List[Tuple[Article, Optional[str]]] = []
+        for page in pages:
+            result = self.prepare(page, check=check)
+            if result is not None:
+                prepared.append(result)
+        texts = [text for _, text in prepared]
+        threshold = self.config.language_threshold
+        langs = detect_languages(texts, threshold=threshold)
+        articles: List[Article] = []
+        for (article, _), lang in zip(prepared, langs):
+            if lang is not None:
+                article.language = lang
+            articles.append(article)
+        return articles
 
-        lang = detect_language(article.text)
-        if lang is not None:
-            article.language = lang
-        return article
+    async def run(
+        self,
+        outpath: Path,
+        sites: List[str],
+        workers: int = 1,
+        incremental: bool = False,
+        format: str = JSONL,
+        rotate_size: int = ROTATE_SIZE,
+    ):
+        """Parse all crawled pages and write the articles to one file per site,
+        or one set of compressed files per site (see `mediacrawl.export`).
+        With more than one worker, batches of pages are parsed in a process pool;
+        at most two batches per worker are in flight, and results are written in
+        the order the pages were read.
 
-    async def run(self, outpath: Path, sites: List[str]):
+        The state in which each page was parsed is recorded. In incremental mode,
+        only pages which changed since they were last parsed are read, and their
+        articles are merged into the existing files."""
+        if incremental and format != JSONL:
+            raise ValueError("Incremental parsing only supports the jsonl format")
         outpath.mkdir(parents=True, exist_ok=True)
-        handles: Dict[str, BufferedWriter] = {}
-        async with engine.connect() as conn:
-            async for page in Page.iter_parse(conn, sites=sites):
-                article = await self.parse(page)
-                if article is None:
-                    continue
-                if article.site not in handles:
-                    path = outpath.joinpath(f"{article.site}.ijson")
-                    handles[article.site] = open(path, "wb")
-                data = article.dict()
-                data["url"] = article.url.url
-                line = orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
-                handles[article.site].write(line)
-
-        for fh in handles.values():
-            fh.close()
+        exporters: Dict[str, Exporter] = {}
+        parsed: List[Dict[str, Any]] = []
+        loop = asyncio.get_running_loop()
+        pool: Optional[Executor] = None
+        if workers > 1:
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(self.config, self.dedupe),
+            )
+        pending: Deque[asyncio.Future[List[Article]]] = deque()
+
+        def write(articles: List[Article]) -> None:
+            by_site: Dict[str, List[Article]] = {}
+            for article in articles:
+                by_site.setdefault(article.site, []).append(article)
+            for site, site_articles in by_site.items():
+                if site not in exporters:
+                    if incremental:
+                        exporter: Exporter = JsonExporter(outpath, site, ".ijson.new")
+                    else:
+                        exporter = create_exporter(outpath, site, format, rotate_size)
+                    exporters[site] = exporter
+                exporters[site].write(site_articles)
+
+        async def submit(batch: List[Page]) -> None:
+            parsed.extend(page.parsed_state for page in batch)
+            if pool is None:
+                write(self.parse_batch(batch))
+                return
+            pending.append(loop.run_in_executor(pool, parse_worker_batch, batch))
+            if len(pending) >= workers * 2:
+                write(await pending.popleft())
+
+        try:
+            async with engine.connect() as conn:
+                await load_dictionaries(conn)
+                pages = Page.iter_parse(
+                    conn,
+                    sites=sites,
+                    by_content=self.dedupe,
+                    incremental=incremental,
+                    where=self.scan_clause,
+                    accept=self.check_scan,
+                )
+                batch: List[Page] = []
+                async for page in pages:
+                    batch.append(page)
+                    if len(batch) >= BATCH_SIZE:
+                        await submit(batch)
+                        batch = []
+                if len(batch):
+                    await submit(batch)
+            while len(pending):
+                write(await pending.popleft())
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            for exporter in exporters.values():
+                exporter.close()
+
+        async with db_connect() as conn:
+            if incremental:
+                urls = [state["url"] for state in parsed]
+                previous = await Page.find_parsed(conn, urls)
+                # Only pages which were parsed before can have an article in
+                # the existing output. Sites without any parse state may have
+                # been parsed before it was recorded, so any of their articles
+                # may be in there:
+                sites_parsed = set(state["site"] for state in parsed)
+                known = await Page.find_parsed_sites(conn, sites_parsed)
+                replaced: Dict[str, Set[str]] = {}
+                for state in parsed:
+                    if state["url"] in previous or state["site"] not in known:
+                        ids = replaced.setdefault(state["site"], set())
+                        ids.add(URL(state["url"]).id)
+                for site in set(exporters.keys()).union(replaced.keys()):
+                    merge_output(outpath, site, replaced.get(site, set()))
+            await Page.save_parsed(conn, parsed)
+        if incremental:
+            log.info("Parsed %d changed pages", len(parsed))
+
+
+def merge_output(outpath: Path, site: str, replaced: Set[str]) -> None:
+    """Merge the articles from an incremental run into the site's output file,
+    dropping previous versions of all pages that were parsed again. If none
+    were, the new articles are just appended."""
+    path = outpath.joinpath(f"{site}.ijson")
+    new_path = outpath.joinpath(f"{site}.ijson.new")
+    tmp_path = outpath.joinpath(f"{site}.ijson.tmp")
+    if not len(replaced):
+        if new_path.exists():
+            with open(path, "ab") as out:
+                with open(new_path, "rb") as fh:
+                    shutil.copyfileobj(fh, out)
+            new_path.unlink()
+        return
+    with open(tmp_path, "wb") as out:
+        if path.exists():
+            with open(path, "rb") as fh:
+                for line in fh:
+                    if orjson.loads(line).get("id") not in replaced:
+                        out.write(line)
+        if new_path.exists():
+            with open(new_path, "rb") as fh:
+                for line in fh:
+                    out.write(line)
+    tmp_path.replace(path)
+    if new_path.exists():
+        new_path.unlink()
+
+
+def init_worker(config: CrawlConfig, dedupe: bool) -> None:
+    global worker_parser
+    logging.basicConfig(level=logging.INFO)
+    worker_parser = Parser(config, dedupe=dedupe)
+
+
+def parse_worker_batch(pages: List[Page], check: bool = True) -> List[Article]:
+    assert worker_parser is not None, "Worker process was not initialized"
+    return worker_parser.parse_batch(pages, check=check)
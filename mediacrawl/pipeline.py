@@ -0,0 +1,217 @@
+import orjson
+import asyncio
+import logging
+import multiprocessing
+import shutil
+from asyncio import Queue
+from hashlib import sha1
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+from articledata import Article
+
+from mediacrawl.config import CrawlConfig
+from mediacrawl.db import db_connect
+from mediacrawl.export import JSONL, ROTATE_SIZE, Exporter, create_exporter
+from mediacrawl.metrics import Metrics
+from mediacrawl.mime import WEB
+from mediacrawl.page import Page
+from mediacrawl.parser import Parser, init_worker, parse_worker_batch
+
+BATCH_SIZE = 50
+MAX_PENDING = 500
+INTERVAL = 5.0
+
+Batch = Tuple[List[Dict[str, Any]], "asyncio.Future[List[Article]]"]
+log = logging.getLogger(__name__)
+
+
+class ParsePipeline(object):
+    """Parse pages while they are being crawled (`crawl --parse`): pages which
+    match their site's parse rules are handed over straight from the crawler,
+    with their decoded text, and extracted in a pool of worker processes. The
+    articles are appended to the per-site output files, and the pages recorded
+    as parsed so that `parse --incremental` skips them.
+
+    Like `parse --incremental`, pages which were parsed before with the same
+    content are skipped. The new articles of changed pages replace their earlier
+    versions in the JSON lines files when the pipeline is closed.
+
+    Pages are sent to the pool in batches of `BATCH_SIZE`, or after `INTERVAL`
+    seconds, or when the pipeline is closed. At most two batches per worker are
+    in flight; once `MAX_PENDING` pages are waiting beyond those, `put` blocks
+    the crawler."""
+
+    def __init__(
+        self,
+        config: CrawlConfig,
+        outpath: Path,
+        workers: int = 2,
+        format: str = JSONL,
+        rotate_size: int = ROTATE_SIZE,
+    ) -> None:
+        self.config = config
+        self.parser = Parser(config)
+        self.outpath = outpath
+        self.workers = max(1, workers)
+        self.format = format
+        self.rotate_size = rotate_size
+        self.exporters: Dict[str, Exporter] = {}
+        # Size of each site's JSON lines file before the crawl, and the IDs of
+        # articles in it which were parsed again:
+        self.offsets: Dict[str, int] = {}
+        self.replaced: Dict[str, Set[str]] = {}
+        # `None` is queued to send off the pages collected so far:
+        self.queue = Queue[Optional[Page]](maxsize=MAX_PENDING)
+        self.batches = Queue[Batch](maxsize=self.workers * 2)
+        self.metrics: Optional[Metrics] = None
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.tasks: List[asyncio.Task[None]] = []
+
+    def start(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+        self.outpath.mkdir(parents=True, exist_ok=True)
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(self.config, False),
+        )
+        self.tasks.append(asyncio.create_task(self.submit()))
+        self.tasks.append(asyncio.create_task(self.collect()))
+
+    async def put(self, page: Page) -> None:
+        if not page.ok or not page.retrieved or page.content_type not in WEB:
+            return
+        # The document was parsed to find the links, so this doesn't parse
+        # it again even for rules on the page content:
+        if not self.parser.check_parse(page):
+            return
+        if page.text is None:
+            return
+        if page.content_hash is None and page.content is not None:
+            page.content_hash = sha1(page.content).hexdigest()
+        # Only the decoded text is needed for the extraction:
+        await self.queue.put(page.copy(update={"content": None, "links": None}))
+
+    async def submit(self) -> None:
+        assert self.pool is not None, "Pipeline was not started"
+        loop = asyncio.get_running_loop()
+        while True:
+            pages: List[Optional[Page]] = [await self.queue.get()]
+            deadline = loop.time() + INTERVAL
+            while len(pages) < BATCH_SIZE and pages[-1] is not None:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pages.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch = [page for page in pages if page is not None]
+            try:
+                if len(batch):
+                    batch = await self.skip_parsed(batch)
+                if len(batch):
+                    states = [page.parsed_state for page in batch]
+                    future = loop.run_in_executor(
+                        self.pool, parse_worker_batch, batch, False
+                    )
+                    await self.batches.put((states, future))
+            except Exception:
+                log.exception("Failed to parse %d pages", len(batch))
+            finally:
+                for _ in pages:
+                    self.queue.task_done()
+
+    async def skip_parsed(self, pages: List[Page]) -> List[Page]:
+        """Drop the pages which were parsed before with the same content, e.g.
+        seeds fetched again, and note the articles replaced by the others."""
+        async with db_connect() as conn:
+            urls = [page.url.url for page in pages]
+            previous = await Page.find_parsed(conn, urls)
+        changed: List[Page] = []
+        for page in pages:
+            if page.url.url in previous:
+                if previous[page.url.url] == page.content_hash:
+                    continue
+                self.replaced.setdefault(page.site, set()).add(page.url.id)
+            changed.append(page)
+        return changed
+
+    async def collect(self) -> None:
+        """Write the articles of each batch once it has been parsed, in the
+        order the batches were sent to the pool."""
+        while True:
+            states, future = await self.batches.get()
+            try:
+                self.write(await future)
+                async with db_connect() as conn:
+                    await Page.save_parsed(conn, states)
+            except Exception:
+                log.exception("Failed to parse %d pages", len(states))
+            finally:
+                self.batches.task_done()
+
+    def write(self, articles: List[Article]) -> None:
+        by_site: Dict[str, List[Article]] = {}
+        for article in articles:
+            by_site.setdefault(article.site, []).append(article)
+        for site, site_articles in by_site.items():
+            if site not in self.exporters:
+                path = self.outpath.joinpath(f"{site}.ijson")
+                if self.format == JSONL:
+                    self.offsets[site] = path.stat().st_size if path.exists() else 0
+                self.exporters[site] = create_exporter(
+                    self.outpath,
+                    site,
+                    self.format,
+                    rotate_size=self.rotate_size,
+                    append=True,
+                )
+            self.exporters[site].write(site_articles)
+            self.exporters[site].flush()
+            if self.metrics is not None:
+                self.metrics.inc("articles", len(site_articles), site=site)
+
+    async def close(self) -> None:
+        """Parse and write all pending pages, then stop the worker processes."""
+        if not len(self.tasks):
+            return
+        await self.queue.put(None)
+        await self.queue.join()
+        await self.batches.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        for exporter in self.exporters.values():
+            exporter.close()
+        self.exporters = {}
+        for site, replaced in self.replaced.items():
+            path = self.outpath.joinpath(f"{site}.ijson")
+            if self.format == JSONL and path.exists():
+                offset = self.offsets.get(site, path.stat().st_size)
+                drop_replaced(path, offset, replaced)
+        self.offsets = {}
+        self.replaced = {}
+
+
+def drop_replaced(path: Path, offset: int, replaced: Set[str]) -> None:
+    """Remove the earlier versions of articles which were parsed again from a
+    JSON lines file, i.e. those in the first `offset` bytes written before the
+    crawl."""
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(path, "rb") as fh:
+        with open(tmp_path, "wb") as out:
+            while fh.tell() < offset:
+                line = fh.readline()
+                if not len(line):
+                    break
+                if orjson.loads(line).get("id") not in replaced:
+                    out.write(line)
+            shutil.copyfileobj(fh, out)
+    tmp_path.replace(path)
@@ -1,21 +1,56 @@
 import re
 from pantomime import normalize_mimetype
 from functools import cached_property
-from typing import List, Literal, Optional, Union
+from typing import Callable, ClassVar, List, Literal, Optional, Tuple, Union
 from pydantic import BaseModel, Field
+from sqlalchemy import and_, or_, false, func
+from sqlalchemy.sql import ColumnElement
 from articledata import URL
 
+from mediacrawl.db import page_table
 from mediacrawl.mime import MIME_GROUPS
 from mediacrawl.page import Page
 
+Check = Callable[[URL, Optional[Page]], Optional[bool]]
+Clause = Optional[ColumnElement]
+# Patterns using back-references can't be merged into a combined regex,
+# since their group numbers would change:
+BACKREF = re.compile(r"\\[1-9]|\(\?P=")
+
 
 class BaseRule(BaseModel):
+    # Relative cost of evaluating the rule, used to order the checks in a
+    # compiled rule tree so that cheap URL checks run before page-based ones:
+    COST: ClassVar[int] = 0
+    # If the rule inspects the page body:
+    CONTENT: ClassVar[bool] = False
+
     class Config:
         keep_untouched = (cached_property,)
 
+    @property
+    def cost(self) -> int:
+        return self.COST
+
+    @property
+    def uses_content(self) -> bool:
+        return self.CONTENT
+
     def check(self, url: URL, page: Optional[Page]) -> Optional[bool]:
         return None
 
+    def compile(self) -> Check:
+        """Return a function with the same results as `check`, but optimised
+        for evaluating the rule many times."""
+        return self.check
+
+    def url_clause(self) -> Clause:
+        """Return an SQL condition on the page URL which holds for every page
+        the rule accepts, or `None` if the rule can't be narrowed down in SQL.
+        The condition may let through pages the rule rejects, so it only
+        pre-filters pages which are then checked as usual."""
+        return None
+
 
 class MatchRule(BaseRule):
     match: Union[Literal["all"], Literal["none"]]
@@ -23,36 +58,116 @@ class MatchRule(BaseRule):
     def check(self, url: URL, page: Optional[Page]) -> Optional[bool]:
         return self.match == "all"
 
+    def url_clause(self) -> Clause:
+        return None if self.match == "all" else false()
+
 
 class OrRule(BaseRule):
     ors: List["Rules"] = Field(..., alias="or")
 
+    @property
+    def cost(self) -> int:
+        return sum(r.cost for r in self.ors)
+
+    @property
+    def uses_content(self) -> bool:
+        return any(r.uses_content for r in self.ors)
+
     def check(self, url: URL, page: Optional[Page]) -> Optional[bool]:
         for rule in self.ors:
             if rule.check(url, page) is True:
                 return True
         return False
 
+    def compile(self) -> Check:
+        # All URL rules below the or are merged into a single matcher:
+        url_rules = [r for r in self.ors if isinstance(r, UrlBaseRule)]
+        others = [r for r in self.ors if not isinstance(r, UrlBaseRule)]
+        parts = [(r.cost, r.compile()) for r in others]
+        if len(url_rules):
+            matcher = UrlMatcher(url_rules)
+            parts.append((matcher.cost, matcher.check))
+        checks = sort_checks(parts)
+
+        def check(url: URL, page: Optional[Page]) -> Optional[bool]:
+            for check in checks:
+                if check(url, page) is True:
+                    return True
+            return False
+
+        return check
+
+    def url_clause(self) -> Clause:
+        clauses = [r.url_clause() for r in self.ors]
+        if any(c is None for c in clauses):
+            return None
+        return or_(*clauses)
+
 
 class AndRule(BaseRule):
     ands: List["Rules"] = Field(..., alias="and")
 
+    @property
+    def cost(self) -> int:
+        return sum(r.cost for r in self.ands)
+
+    @property
+    def uses_content(self) -> bool:
+        return any(r.uses_content for r in self.ands)
+
     def check(self, url: URL, page: Optional[Page]) -> Optional[bool]:
         for rule in self.ands:
             if rule.check(url, page) is False:
                 return False
         return True
 
+    def compile(self) -> Check:
+        checks = sort_checks([(r.cost, r.compile()) for r in self.ands])
+
+        def check(url: URL, page: Optional[Page]) -> Optional[bool]:
+            for check in checks:
+                if check(url, page) is False:
+                    return False
+            return True
+
+        return check
+
+    def url_clause(self) -> Clause:
+        clauses = [r.url_clause() for r in self.ands]
+        clauses = [c for c in clauses if c is not None]
+        if not len(clauses):
+            return None
+        return and_(*clauses)
+
 
 class NotRule(BaseRule):
     not_rule: "Rules" = Field(..., alias="not")
 
+    @property
+    def cost(self) -> int:
+        return self.not_rule.cost
+
+    @property
+    def uses_content(self) -> bool:
+        return self.not_rule.uses_content
+
     def check(self, url: URL, page: Optional[Page]) -> Optional[bool]:
         result = self.not_rule.check(url, page)
         if result is None:
             return None
         return not result
 
+    def compile(self) -> Check:
+        inner = self.not_rule.compile()
+
+        def check(url: URL, page: Optional[Page]) -> Optional[bool]:
+            result = inner(url, page)
+            if result is None:
+                return None
+            return not result
+
+        return check
+
 
 class UrlBaseRule(BaseRule):
     def check_url(self, url: URL) -> bool:
@@ -66,8 +181,12 @@ class UrlBaseRule(BaseRule):
                 return True
         return False
 
+    def compile(self) -> Check:
+        return UrlMatcher([self]).check
+
 
 class DomainRule(UrlBaseRule):
+    COST = 1
     domain: str
 
     @cached_property
@@ -81,8 +200,14 @@ class DomainRule(UrlBaseRule):
             return True
         return False
 
+    def url_clause(self) -> Clause:
+        # There's no domain column, but the domain must be part of the URL:
+        url = func.lower(page_table.c.url)
+        return url.contains(self.cleaned_domain, autoescape=True)
+
 
 class PatternRule(UrlBaseRule):
+    COST = 2
     pattern: str
 
     @cached_property
@@ -94,13 +219,19 @@ class PatternRule(UrlBaseRule):
 
 
 class PrefixRule(UrlBaseRule):
+    COST = 1
     prefix: str
 
     def check_url(self, url: URL) -> bool:
         return url.url.startswith(self.prefix)
 
+    def url_clause(self) -> Clause:
+        return page_table.c.url.startswith(self.prefix, autoescape=True)
+
 
 class XpathRule(BaseRule):
+    COST = 20
+    CONTENT = True
     xpath: str
 
     def check(self, url: URL, page: Optional[Page]) -> Optional[bool]:
@@ -113,6 +244,8 @@ class XpathRule(BaseRule):
 
 
 class ElementRule(BaseRule):
+    COST = 10
+    CONTENT = True
     element: str
 
     def check(self, url: URL, page: Optional[Page]) -> Optional[bool]:
@@ -125,6 +258,7 @@ class ElementRule(BaseRule):
 
 
 class MimeTypeRule(BaseRule):
+    COST = 3
     mime: str
 
     @cached_property
@@ -155,6 +289,83 @@ Rules = Union[
     ElementRule,
     MimeTypeRule,
 ]
+
+
+class UrlMatcher(object):
+    """Evaluate a set of URL rules at once: domains are looked up by suffix in a
+    set, prefixes are matched in one `startswith` call and patterns are merged
+    into a single regular expression."""
+
+    def __init__(self, rules: List[UrlBaseRule]) -> None:
+        self.cost = max(r.cost for r in rules)
+        self.domains = set()
+        prefixes: List[str] = []
+        patterns: List[str] = []
+        self.rexes: List[re.Pattern] = []
+        for rule in rules:
+            if isinstance(rule, DomainRule):
+                self.domains.add(rule.cleaned_domain)
+            elif isinstance(rule, PrefixRule):
+                prefixes.append(rule.prefix)
+            elif isinstance(rule, PatternRule):
+                if BACKREF.search(rule.pattern) is None:
+                    patterns.append(rule.pattern)
+                else:
+                    self.rexes.append(rule.rex)
+        self.prefixes = tuple(prefixes)
+        if len(patterns):
+            combined = "|".join(f"(?:{p})" for p in patterns)
+            try:
+                self.rexes.insert(0, re.compile(combined, re.I | re.U))
+            except re.error:
+                self.rexes.extend(re.compile(p, re.I | re.U) for p in patterns)
+
+    def check_domain(self, domain: str) -> bool:
+        if domain in self.domains:
+            return True
+        index = domain.find(".")
+        while index != -1:
+            if domain[index + 1 :] in self.domains:
+                return True
+            index = domain.find(".", index + 1)
+        return False
+
+    def check_url(self, url: URL) -> bool:
+        if len(self.domains) and self.check_domain(url.domain):
+            return True
+        if len(self.prefixes) and url.url.startswith(self.prefixes):
+            return True
+        for rex in self.rexes:
+            if rex.match(url.url) is not None:
+                return True
+        return False
+
+    def check(self, url: URL, page: Optional[Page]) -> Optional[bool]:
+        if self.check_url(url):
+            return True
+        if page is not None and page.url is not None and page.url != url:
+            if self.check_url(page.url):
+                return True
+        return False
+
+
+def sort_checks(parts: List[Tuple[int, Check]]) -> List[Check]:
+    parts = sorted(parts, key=lambda p: p[0])
+    return [check for _, check in parts]
+
+
+def compile_rules(rules: Optional[BaseRule]) -> Optional[Check]:
+    if rules is None:
+        return None
+    return rules.compile()
+
+
+def rules_clause(rules: Optional[BaseRule]) -> Clause:
+    if rules is None:
+        return None
+    return rules.url_clause()
+
+
 AndRule.update_forward_refs()
 OrRule.update_forward_refs()
 NotRule.update_forward_refs()
@@ -0,0 +1,217 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Tuple
+
+from mediacrawl.config import SiteConfig
+
+if TYPE_CHECKING:
+    from mediacrawl.task import Task
+
+# Responses by which a server asks the crawler to slow down:
+THROTTLE_STATUS = (429, 503)
+# Concurrency a host starts at when it is adjusted to the host's responses:
+INITIAL_CONCURRENCY = 2
+# Latency above this multiple of the fastest seen for a host is taken as a
+# sign that it is under load, and concurrency is not raised any further:
+LATENCY_TOLERANCE = 2.0
+LATENCY_WEIGHT = 0.2
+# How much slower concurrency grows near the level at which the host last
+# throttled the crawler:
+PROBE_SLOWDOWN = 10.0
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+MAX_RETRY_AFTER = 600.0
+log = logging.getLogger(__name__)
+
+
+class Host(object):
+    """Politeness state for one domain of a site: the tasks waiting to be fetched
+    from it, the number of requests in flight and when the next may start.
+
+    With `adaptive` enabled, the number of concurrent requests follows the
+    host's responses: it grows by one for each round of fast, successful
+    responses, up to `domain_concurrency`, and is halved when the host throttles
+    the crawler or requests to it fail."""
+
+    def __init__(self, name: str, config: SiteConfig) -> None:
+        self.name = name
+        self.config = config
+        self.tasks: Deque["Task"] = deque()
+        self.active = 0
+        self.ready_at = 0.0
+        self.scheduled = False
+        self.limit = float(config.domain_concurrency)
+        if config.adaptive:
+            self.limit = float(min(INITIAL_CONCURRENCY, config.domain_concurrency))
+        # Average and lowest time from request to response headers:
+        self.latency: Optional[float] = None
+        self.fastest: Optional[float] = None
+        self.backoff = 0.0
+        self.slowed_at: Optional[float] = None
+        self.slowed_limit: Optional[float] = None
+
+    @property
+    def available(self) -> bool:
+        return len(self.tasks) > 0 and self.active < max(1, int(self.limit))
+
+    def speed_up(self, latency: float) -> None:
+        """Record a successful response from the host."""
+        if self.latency is None:
+            self.latency = latency
+        self.latency += LATENCY_WEIGHT * (latency - self.latency)
+        if self.fastest is None or latency < self.fastest:
+            self.fastest = latency
+        self.backoff = self.backoff / 2 if self.backoff > MIN_BACKOFF else 0.0
+        if not self.config.adaptive:
+            return
+        if self.latency > self.fastest * LATENCY_TOLERANCE:
+            return
+        step = 1.0 / self.limit
+        if self.slowed_limit is not None and self.limit + 1 >= self.slowed_limit:
+            step = step / PROBE_SLOWDOWN
+        ceiling = float(self.config.domain_concurrency)
+        self.limit = min(ceiling, self.limit + step)
+
+    def slow_down(self, now: float, retry_after: Optional[float]) -> None:
+        """Record a throttled or failed request to the host."""
+        if retry_after is not None:
+            retry_after = min(retry_after, MAX_RETRY_AFTER)
+            self.ready_at = max(self.ready_at, now + retry_after)
+        # Requests sent before the last slow-down fail together, and are only
+        # counted once:
+        window = max(self.latency or MIN_BACKOFF, MIN_BACKOFF)
+        if self.slowed_at is not None and now - self.slowed_at < window:
+            return
+        self.slowed_at = now
+        # A server which says when to retry doesn't need a further pause:
+        if retry_after is None:
+            self.backoff = min(MAX_BACKOFF, max(MIN_BACKOFF, self.backoff * 2))
+        if self.config.adaptive:
+            self.slowed_limit = self.limit
+            self.limit = max(1.0, self.limit / 2)
+        log.info(
+            "Slowing down [%s]: %d concurrent, %.1fs between requests",
+            self.name,
+            max(1, int(self.limit)),
+            self.backoff,
+        )
+
+    def __repr__(self) -> str:
+        return f"<Host({self.name!r})>"
+
+
+class Scheduler(object):
+    """Hand out work to the crawler's workers. New tasks are served in the order
+    they were added. Tasks which need to fetch a page are deferred into a queue
+    for their host, and only handed to a worker once the host is allowed another
+    request, so that no worker sits idle waiting on a slow or rate-limited site.
+    Failed tasks wait to be retried in the same way, and re-join the queue of
+    their host once their backoff has passed."""
+
+    def __init__(self) -> None:
+        self.incoming: Deque["Task"] = deque()
+        self.hosts: Dict[Tuple[str, str], Host] = {}
+        self.ready: List[Tuple[float, int, Host]] = []
+        self.retries: List[Tuple[float, int, "Task"]] = []
+        self.counter = count()
+        self.deferred = 0
+        self.wakeup = asyncio.Event()
+
+    def get_host(self, task: "Task") -> Host:
+        key = (task.site.config.name, task.url.domain)
+        if key not in self.hosts:
+            self.hosts[key] = Host(task.url.domain, task.site.config)
+        return self.hosts[key]
+
+    def schedule(self, host: Host) -> None:
+        if host.scheduled or not host.available:
+            return
+        host.scheduled = True
+        heappush(self.ready, (host.ready_at, next(self.counter), host))
+
+    def put(self, task: "Task") -> None:
+        self.incoming.append(task)
+        self.wakeup.set()
+
+    def defer(self, task: "Task") -> None:
+        host = self.get_host(task)
+        host.tasks.append(task)
+        self.deferred += 1
+        self.schedule(host)
+        self.wakeup.set()
+
+    def release(self, task: "Task") -> None:
+        """Mark a fetch as completed, adjusting the host's concurrency to how
+        it responded and allowing the next request after the configured delay,
+        or longer if the host is backing off."""
+        host = self.get_host(task)
+        host.active -= 1
+        now = asyncio.get_running_loop().time()
+        if task.failed or task.status in THROTTLE_STATUS:
+            host.slow_down(now, task.retry_after)
+        elif task.status is not None and task.status < 500:
+            if task.latency is not None:
+                host.speed_up(task.latency)
+        delay = host.config.delay * (0.8 + (0.4 * random.random()))
+        host.ready_at = max(host.ready_at, now + max(delay, host.backoff))
+        self.schedule(host)
+        self.wakeup.set()
+
+    def retry(self, task: "Task", delay: float) -> None:
+        """Fetch the task again once the delay has passed."""
+        retry_at = asyncio.get_running_loop().time() + delay
+        heappush(self.retries, (retry_at, next(self.counter), task))
+        self.wakeup.set()
+
+    def pop_retries(self, now: float) -> None:
+        while len(self.retries) and self.retries[0][0] <= now:
+            _, _, task = heappop(self.retries)
+            task.deferred_at = time.monotonic()
+            self.defer(task)
+
+    def pop_ready(self, now: float) -> Optional["Task"]:
+        while len(self.ready) and self.ready[0][0] <= now:
+            _, _, host = heappop(self.ready)
+            host.scheduled = False
+            if host.ready_at > now:
+                self.schedule(host)
+                continue
+            if not host.available:
+                continue
+            host.active += 1
+            self.deferred -= 1
+            task = host.tasks.popleft()
+            self.schedule(host)
+            return task
+        return None
+
+    async def get(self) -> Tuple["Task", bool]:
+        """Wait for the next task. The flag returned with it is `True` if the
+        task is cleared to fetch from its host."""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            self.pop_retries(now)
+            task = self.pop_ready(now)
+            if task is not None:
+                return task, True
+            if len(self.incoming):
+                return self.incoming.popleft(), False
+            waits = [q[0][0] - now for q in (self.ready, self.retries) if len(q)]
+            timeout = min(waits) if len(waits) else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @property
+    def empty(self) -> bool:
+        if len(self.incoming) or len(self.retries):
+            return False
+        return self.deferred == 0
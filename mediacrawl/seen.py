@@ -0,0 +1,128 @@
+import math
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from typing import List, Set
+from articledata import URL
+
+from mediacrawl.config import SeenConfig
+
+# Fingerprints are split by their top bits into this many partitions:
+PARTITION_BITS = 8
+MIN_BUFFER = 256
+
+
+def fingerprint(url: URL) -> int:
+    """A 64-bit fingerprint of the normalised URL, consistent with `URL.__eq__`."""
+    return int(url.id[:16], 16)
+
+
+class SeenSet(ABC):
+    """Record which URLs have been discovered during a crawl."""
+
+    @abstractmethod
+    def add(self, url: URL) -> bool:
+        """Add the URL to the set, returns `False` if it was already present."""
+
+    @abstractmethod
+    def __contains__(self, url: URL) -> bool:
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+
+class FingerprintSet(SeenSet):
+    """Exact (modulo fingerprint collisions) set of URLs, stored as sorted arrays
+    of 64-bit integers, one per partition of the fingerprints. New fingerprints
+    are collected in a small buffer per partition, which is merged into its array
+    once it has grown to a fraction of its size. Since each merge only touches
+    one partition, it doesn't hold up the crawl even for very large sets."""
+
+    def __init__(self) -> None:
+        partitions = 1 << PARTITION_BITS
+        self.sorted: List[array] = [array("Q") for _ in range(partitions)]
+        self.buffers: List[Set[int]] = [set() for _ in range(partitions)]
+        self.count = 0
+
+    def _contains(self, fp: int) -> bool:
+        part = fp >> (64 - PARTITION_BITS)
+        if fp in self.buffers[part]:
+            return True
+        run = self.sorted[part]
+        idx = bisect_left(run, fp)
+        return idx < len(run) and run[idx] == fp
+
+    def _compact(self, part: int) -> None:
+        # Sorting two concatenated sorted runs merges them in linear time:
+        merged = self.sorted[part].tolist()
+        merged.extend(sorted(self.buffers[part]))
+        merged.sort()
+        self.sorted[part] = array("Q", merged)
+        self.buffers[part] = set()
+
+    def add(self, url: URL) -> bool:
+        fp = fingerprint(url)
+        if self._contains(fp):
+            return False
+        part = fp >> (64 - PARTITION_BITS)
+        buffer = self.buffers[part]
+        buffer.add(fp)
+        self.count += 1
+        if len(buffer) > max(MIN_BUFFER, len(self.sorted[part]) >> 3):
+            self._compact(part)
+        return True
+
+    def __contains__(self, url: URL) -> bool:
+        return self._contains(fingerprint(url))
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class BloomSet(SeenSet):
+    """Probabilistic set of URLs with a fixed memory footprint, sized for the
+    expected number of URLs and an acceptable false-positive rate. A false
+    positive means a URL is considered seen and will not be crawled."""
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.size = max(8, int(math.ceil(bits)))
+        self.hashes = max(1, int(round((self.size / capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, fp: int):
+        h1 = fp & 0xFFFFFFFF
+        h2 = (fp >> 32) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, url: URL) -> bool:
+        added = False
+        for idx in self._indexes(fingerprint(url)):
+            byte, bit = divmod(idx, 8)
+            mask = 1 << bit
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, url: URL) -> bool:
+        for idx in self._indexes(fingerprint(url)):
+            byte, bit = divmod(idx, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def __len__(self) -> int:
+        return self.count
+
+
+def create_seen(config: SeenConfig) -> SeenSet:
+    if config.mode == "bloom":
+        return BloomSet(config.capacity, config.error_rate)
+    return FingerprintSet()
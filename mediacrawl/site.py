@@ -1,41 +1,76 @@
-import random
-import asyncio
-from asyncio import Semaphore
-from contextlib import asynccontextmanager
-from typing import TYPE_CHECKING, AsyncGenerator, Dict, Generator
+import time
+from typing import TYPE_CHECKING, Generator, Optional, Set
 from articledata import URL
 
 from mediacrawl.config import SiteConfig
+from mediacrawl.frontier import SEED
+from mediacrawl.rule import compile_rules
 from mediacrawl.task import Task
 
 if TYPE_CHECKING:
     from mediacrawl.crawler import Crawler
 
+# Frontier priority added for URLs which the parse rules accept, and taken
+# off for those they reject, outweighing a few levels of depth:
+ARTICLE_BONUS = 10
+SEED_BONUS = 100
+
 
 class Site(object):
     def __init__(self, crawler: "Crawler", config: SiteConfig) -> None:
         self.crawler = crawler
         self.config = config
-        self.semaphores: Dict[str, Semaphore] = {}
+        self.crawl_rules = compile_rules(config.crawl)
+        # Cached pages only need to be loaded with their body if the crawl
+        # rules look at it:
+        self.crawl_content = False
+        if config.crawl is not None:
+            self.crawl_content = config.crawl.uses_content
+        # Stored pages to be fetched again, like the seeds, because a sitemap
+        # or feed says they were modified:
+        self.refresh: Set[URL] = set()
+        # Rank URLs by whether they look like articles, from the URL alone. A
+        # rejection only counts if the rules can be decided without the page:
+        self.parse_rules = compile_rules(config.parse)
+        self.parse_content = False
+        if config.parse is not None:
+            self.parse_content = config.parse.uses_content
+        # Set by `start` once the site is being crawled, after discovery:
+        self.started: Optional[float] = None
+        self.fetched = 0
+
+    def start(self) -> None:
+        """Start the clock of the site's time budget."""
+        self.started = time.monotonic()
 
     def seeds(self) -> Generator[Task, None, None]:
         for url in self.config.urls:
-            yield Task(self, url)
-
-    # def is_delay_locked(self, url: URL) -> bool:
-    #     if url.domain in self.semaphores:
-    #         return self.semaphores[url.domain].locked()
-    #     return False
-
-    @asynccontextmanager
-    async def delay_url(self, url: URL) -> AsyncGenerator[URL, None]:
-        if url.domain not in self.semaphores:
-            self.semaphores[url.domain] = Semaphore(self.config.domain_concurrency)
-        async with self.semaphores[url.domain]:
-            delay = self.config.delay * 0.8
-            wait = delay * ((self.config.delay * 0.4) * random.random())
-            await asyncio.sleep(wait)
-            yield url
+            yield Task(self, url, source=SEED)
+
+    def score(self, url: URL, depth: int, source: str) -> int:
+        """Frontier priority of a URL: shallow pages come first, and pages the
+        parse rules accept before those they don't."""
+        priority = -depth
+        if source == SEED:
+            priority += SEED_BONUS
+        if self.parse_rules is not None:
+            result = self.parse_rules(url, None)
+            if result is True:
+                priority += ARTICLE_BONUS
+            elif result is False and not self.parse_content:
+                priority -= ARTICLE_BONUS
+        return priority
+
+    @property
+    def exhausted(self) -> bool:
+        """Check if the site's page or time budget for this run is used up."""
+        if self.config.max_pages is not None:
+            if self.fetched >= self.config.max_pages:
+                return True
+        if self.config.max_time is not None and self.started is not None:
+            if time.monotonic() - self.started >= self.config.max_time:
+                return True
+        return False
 
     def __repr__(self) -> str:
         return f"<Site({self.config.name!r})>"
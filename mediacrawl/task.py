@@ -1,4 +1,8 @@
+import time
+import random
 import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from typing import TYPE_CHECKING, Generator, Optional, Set
 from asyncio.exceptions import TimeoutError
 from aiohttp import ClientSession, ClientResponse
@@ -8,19 +12,61 @@ from articledata import URL
 
 from mediacrawl.page import Page
 from mediacrawl.db import db_connect
+from mediacrawl.frontier import LINK
+from mediacrawl.scheduler import THROTTLE_STATUS
 
 if TYPE_CHECKING:
     from mediacrawl.site import Site
 
 MAX_CONTENT: int = 1024 * 1024 * 20
+CHUNK_SIZE: int = 1024 * 64
+MAX_RETRY_DELAY: float = 300.0
 log = logging.getLogger(__name__)
 
 
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a `Retry-After` header, given either in seconds or as a date, into
+    the number of seconds to wait."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
 class Task(object):
-    def __init__(self, site: "Site", url: URL) -> None:
+    def __init__(
+        self, site: "Site", url: URL, depth: int = 0, source: str = LINK
+    ) -> None:
         self.site = site
         self.crawler = site.crawler
         self.url = url
+        # Number of links followed from a seed to get here, and how the URL was
+        # found (see `mediacrawl.frontier`):
+        self.depth = depth
+        self.source = source
+        self.cached: Optional[Page] = None
+        self.started = 0.0
+        self.bytes_read = 0
+        self.time_to_last_byte: Optional[float] = None
+        self.deferred_at = 0.0
+        self.attempts = 0
+        # How the host responded to the fetch, used to adjust its concurrency
+        # and to decide if the fetch is retried:
+        self.status: Optional[int] = None
+        self.latency: Optional[float] = None
+        self.retry_after: Optional[float] = None
+        self.failed = False
+        self.error: Optional[str] = None
+        # Set once the page has been handed to the writer:
+        self.stored = False
 
     async def enqueue(self, url: URL) -> None:
         if url.scheme not in ["http", "https"]:
@@ -29,17 +75,23 @@ class Task(object):
 
         # Check url-based rules only:)
         if not self.check_crawl(url, None):
+            self.crawler.metrics.inc("rejected", site=self.site_name, stage="link")
+            return
+
+        depth = self.depth + 1
+        max_depth = self.site.config.max_depth
+        if max_depth is not None and depth > max_depth:
+            self.crawler.metrics.inc("rejected", site=self.site_name, stage="depth")
             return
 
-        if url in self.crawler.seen:
+        if not self.crawler.seen.add(url):
             return
-        self.crawler.seen.add(url)
-        task = Task(self.site, url)
-        await self.crawler.queue.put(task)
+        priority = self.site.score(url, depth, LINK)
+        self.crawler.frontier.push(self.site_name, url, depth, LINK, priority)
 
     def check_crawl(self, url: URL, page: Optional[Page]) -> bool:
-        if self.site.config.crawl is not None:
-            if self.site.config.crawl.check(url, page) is False:
+        if self.site.crawl_rules is not None:
+            if self.site.crawl_rules(url, page) is False:
                 return False
         return True
 
@@ -66,9 +118,17 @@ class Task(object):
             if next_url is not None:
                 yield next_url
 
+    @property
+    def site_name(self) -> str:
+        return self.site.config.name
+
     async def handle_page(self, page: Page) -> None:
         # page.parse = False
         if not self.check_crawl(self.url, page):
+            # Pages skipped based on their headers are already counted:
+            if page.retrieved:
+                metrics = self.crawler.metrics
+                metrics.inc("rejected", site=self.site_name, stage="page")
             return
         if not page.ok:
             return
@@ -76,56 +136,173 @@ class Task(object):
         # if self.check_parse(self.url, page):
         #     page.parse = True
 
-        for next_url in self.extract_urls(page):
+        # The links are stored along with the page, see `handle_cached`:
+        page.links = list(self.extract_urls(page))
+        page.outlinks = len(page.links)
+        for next_url in page.links:
+            await self.enqueue(next_url)
+
+    async def handle_cached(self, page: Page) -> None:
+        """Follow the links of a previously crawled page, using the links stored
+        for it rather than parsing the body again where possible."""
+        if not self.check_crawl(self.url, page):
+            return
+        if not page.ok:
+            return
+        if self.crawler.discover:
+            # Only new pages are crawled when discovering from sitemaps:
+            return
+        if page.links is None:
+            # Crawled before links were stored, so the HTML must be parsed:
+            if not page.retrieved:
+                async with db_connect() as conn:
+                    page = await Page.find(conn, self.url) or page
+            await self.handle_page(page)
+            return
+        for next_url in page.links:
             await self.enqueue(next_url)
 
+    @property
+    def should_retry(self) -> bool:
+        if self.failed:
+            return True
+        return self.status in self.site.config.retry.statuses
+
+    @property
+    def retry_delay(self) -> float:
+        """Back off exponentially from the configured delay, with jitter, but
+        wait at least as long as the server asked to."""
+        backoff = self.site.config.retry.backoff * (2 ** (self.attempts - 1))
+        delay = min(backoff, MAX_RETRY_DELAY) * (0.5 + random.random())
+        if self.retry_after is not None:
+            delay = max(delay, self.retry_after)
+        return delay
+
+    @property
+    def max_content(self) -> int:
+        if self.site.config.max_content is None:
+            return MAX_CONTENT
+        return min(MAX_CONTENT, self.site.config.max_content)
+
+    def check_headers(self, page: Page, response: ClientResponse) -> bool:
+        """Decide if the page body should be downloaded, based on the response
+        headers alone."""
+        if not self.check_crawl(self.url, page):
+            return False
+        if self.site.config.max_content is not None:
+            length = response.content_length
+            if length is not None and length > self.site.config.max_content:
+                return False
+        return True
+
     async def retrieve_content(self, page: Page, response: ClientResponse) -> None:
-        content = b""
+        """Read the response body into a growing buffer, up to `Content-Length`
+        if it is given, and never more than the content limit."""
+        limit = self.max_content
+        length = response.content_length
+        # The length of an encoded body is that before decompression:
+        if length is not None and "Content-Encoding" not in response.headers:
+            limit = min(limit, length)
+        content = bytearray()
         try:
-            while True:
-                buffer = await response.content.read(MAX_CONTENT)
+            while len(content) < limit:
+                chunk_size = min(CHUNK_SIZE, limit - len(content))
+                buffer = await response.content.read(chunk_size)
                 if not len(buffer):
                     break
-                content = content + buffer
-                if len(content) >= MAX_CONTENT:
-                    break
+                content += buffer
         except ClientPayloadError as payerr:
             log.warning("Did not load full page: %s", payerr)
+        self.bytes_read = len(content)
+        elapsed = time.monotonic() - self.started
+        self.time_to_last_byte = elapsed
+        log.debug(
+            "Retrieved [%d bytes, %.2fs]: %r",
+            self.bytes_read,
+            self.time_to_last_byte,
+            self.url,
+        )
         page.retrieved = True
-        page.content = content
-
-    async def crawl(self, http: ClientSession) -> None:
-        if self.url not in self.site.config.urls:
-            async with db_connect() as conn:
-                cached = await Page.find(conn, self.url)
-                if cached is not None:
-                    # log.info("Cache hit: %r", cached.url)
-                    await self.handle_page(cached)
-                    # await cached.update_parse(conn)
-                    return
+        page.content = bytes(content)
+        metrics = self.crawler.metrics
+        metrics.inc("bytes", self.bytes_read, site=self.site_name)
+        metrics.observe("fetch_seconds", elapsed, site=self.site_name)
 
-        # if self.site.is_delay_locked(self.url):
-        #     # log.info("Locked, going to wait...")
-        # #     # log.info("Putting %r back on the queue", self)
-        # #     self.site.crawler.seen.remove(self.url)
-        #     await self.site.crawler.queue.put(self)
-        #     return
-
-        async with self.site.delay_url(self.url):
-            try:
-                async with http.get(self.url.url, max_redirects=3) as response:
-                    if response.status > 299:
-                        return
+    async def lookup(self) -> bool:
+        """Try to handle the task using a previously retrieved copy of the page.
+        Returns `False` if the page needs to be fetched."""
+        async with db_connect() as conn:
+            content = self.site.crawl_content
+            cached = await Page.find(conn, self.url, content=content)
+            if cached is not None and cached.outlinks is not None:
+                cached.links = await Page.find_links(conn, cached.url)
+        if cached is None:
+            return False
+        if self.url in self.site.config.urls or self.url in self.site.refresh:
+            # Seed pages are always re-fetched, but only downloaded again if
+            # they have been modified:
+            self.cached = cached
+            return False
+        # log.info("Cache hit: %r", cached.url)
+        self.crawler.metrics.inc("cache_hits", site=self.site_name)
+        await self.handle_cached(cached)
+        return True
+
+    async def fetch(self, http: ClientSession) -> None:
+        headers = {} if self.cached is None else self.cached.validators
+        page: Optional[Page] = None
+        self.started = time.monotonic()
+        if self.attempts == 0:
+            self.site.fetched += 1
+        self.attempts += 1
+        self.status = self.latency = self.retry_after = self.error = None
+        self.failed = False
+        try:
+            async with http.get(
+                self.url.url, headers=headers, max_redirects=3
+            ) as response:
+                self.status = response.status
+                self.latency = time.monotonic() - self.started
+                status = str(response.status)
+                self.crawler.metrics.inc("fetches", site=self.site_name, status=status)
+                if response.status == 304 and self.cached is not None:
+                    log.info("Not modified: %r", self.url)
+                elif response.status in THROTTLE_STATUS:
+                    retry_after = response.headers.get("Retry-After")
+                    self.retry_after = parse_retry_after(retry_after)
+                    self.error = status
+                    log.info("Throttled [%d]: %r", response.status, self.url)
+                    return
+                elif response.status > 299:
+                    self.error = status
+                    return
+                else:
                     log.info("Crawl [%d]: %r", response.status, self.url)
                     page = Page.from_response(self.site.config.name, self.url, response)
-                    await self.retrieve_content(page, response)
-            except (ClientConnectionError, TimeoutError, TooManyRedirects) as ce:
-                log.error("Error [%r]: %r", self, ce)
-                return
+                    if self.check_headers(page, response):
+                        await self.retrieve_content(page, response)
+                    else:
+                        # Drop the connection rather than reading the body:
+                        log.info("Skip [%s]: %r", page.content_type, self.url)
+                        metrics = self.crawler.metrics
+                        metrics.inc("rejected", site=self.site_name, stage="headers")
+                        response.close()
+        except (ClientConnectionError, TimeoutError, TooManyRedirects) as ce:
+            self.failed = not isinstance(ce, TooManyRedirects)
+            error = self.error = type(ce).__name__
+            self.crawler.metrics.inc("errors", site=self.site_name, error=error)
+            log.error("Error [%r]: %r", self, ce)
+            return
 
+        if page is None:
+            if self.cached is not None:
+                await self.handle_cached(self.cached)
+            return
         await self.handle_page(page)
-        async with db_connect() as conn:
-            await page.save(conn)
+        self.stored = True
+        await self.crawler.writer.put(page)
+        if self.crawler.pipeline is not None:
+            await self.crawler.pipeline.put(page)
 
     def __repr__(self) -> str:
         return f"<Task({self.site!r}, {self.url!r})>"
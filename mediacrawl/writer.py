@@ -0,0 +1,88 @@
+import time
+import asyncio
+import logging
+from asyncio import Queue
+from typing import List, Optional
+
+from mediacrawl.db import db_connect
+from mediacrawl.frontier import Frontier
+from mediacrawl.metrics import Metrics
+from mediacrawl.page import Page
+
+BATCH_SIZE = 200
+BATCH_BYTES = 1024 * 1024 * 32
+MAX_PENDING = 1000
+INTERVAL = 1.0
+
+log = logging.getLogger(__name__)
+
+
+class PageWriter(object):
+    """Write-behind buffer for crawled pages: pages are handed to a single writer
+    task, which stores them in batches once `BATCH_SIZE` pages (or `BATCH_BYTES`
+    of content) have been collected, or `INTERVAL` seconds have passed. When
+    `MAX_PENDING` pages are waiting to be written, `put` blocks the caller.
+
+    The URLs of the pages are only marked as done in the frontier once they
+    have been stored, so that a crawl which is killed with pages still waiting
+    fetches them again when it resumes. Pages which cannot be stored are marked
+    as failed, to be fetched again by the next crawl."""
+
+    def __init__(self, metrics: Metrics, frontier: Frontier) -> None:
+        self.metrics = metrics
+        self.frontier = frontier
+        self.queue = Queue[Page](maxsize=MAX_PENDING)
+        self.task: Optional[asyncio.Task[None]] = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, page: Page) -> None:
+        await self.queue.put(page)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[Page] = [await self.queue.get()]
+            size = len(batch[0].content or b"")
+            deadline = loop.time() + INTERVAL
+            while len(batch) < BATCH_SIZE and size < BATCH_BYTES:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    page = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(page)
+                size += len(page.content or b"")
+            try:
+                await self.write(batch)
+            except Exception as exc:
+                log.exception("Failed to write %d pages", len(batch))
+                for page in batch:
+                    self.frontier.fail(page.original_url, 1, type(exc).__name__)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def write(self, batch: List[Page]) -> None:
+        started = time.monotonic()
+        async with db_connect() as conn:
+            await Page.save_many(conn, batch)
+        for page in batch:
+            self.frontier.complete(page.original_url)
+        self.metrics.observe("db_write_seconds", time.monotonic() - started)
+        self.metrics.inc("pages_written", len(batch))
+
+    async def close(self) -> None:
+        """Write all pending pages and stop the writer task."""
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
@@ -1,2 +1,14 @@
 
-ALTER TABLE page DROP COLUMN parse;
\ No newline at end of file
+ALTER TABLE page DROP COLUMN parse;
+ALTER TABLE page ADD COLUMN codec VARCHAR(64);
+ALTER TABLE page ADD COLUMN content_hash VARCHAR(64);
+CREATE INDEX ix_page_content_hash ON page (content_hash);
+ALTER TABLE page ADD COLUMN outlinks INTEGER;
+ALTER TABLE page ADD COLUMN encoding VARCHAR(64);
+ALTER TABLE frontier ADD COLUMN host_hash INTEGER;
+ALTER TABLE frontier ADD COLUMN attempts INTEGER;
+ALTER TABLE frontier ADD COLUMN error VARCHAR(1024);
+ALTER TABLE frontier ADD COLUMN depth INTEGER;
+ALTER TABLE frontier ADD COLUMN source VARCHAR(16);
+ALTER TABLE frontier ADD COLUMN priority INTEGER;
+CREATE INDEX ix_frontier_priority ON frontier (priority);
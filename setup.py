@@ -35,6 +35,7 @@ setup(
         "fasttext",
         "languagecodes",
         "charset-normalizer",
+        "zstandard",
         "shortuuid >= 1.0.1, < 2.0.0",
         "click >= 8.0.0, < 8.1.0",
     ],
@@ -45,6 +46,7 @@ setup(
         ],
     },
     extras_require={
+        "parquet": ["pyarrow"],
         "dev": [
             "wheel>=0.29.0",
             "twine",
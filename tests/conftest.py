@@ -0,0 +1,23 @@
+import os
+import asyncio
+import tempfile
+import pytest
+
+# The database engine is created when `mediacrawl.db` is first imported:
+os.environ["MEDIACRAWL_DATABASE_URL"] = "sqlite+aiosqlite:///%s" % os.path.join(
+    tempfile.mkdtemp(), "mediacrawl.db"
+)
+
+from mediacrawl.db import engine, meta  # noqa: E402
+
+
+async def reset_db() -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(meta.drop_all)
+        await conn.run_sync(meta.create_all)
+
+
+@pytest.fixture
+def db():
+    asyncio.run(reset_db())
+    yield engine
@@ -0,0 +1,66 @@
+import asyncio
+from datetime import datetime
+from typing import List
+
+from mediacrawl.config import SiteConfig
+from mediacrawl.discovery import PAGE, SITEMAP, Discovery, FeedParser, parse_date
+from mediacrawl.site import Site
+
+
+def test_parse_date_w3c():
+    assert parse_date("2023-01-05T10:00:00Z") == datetime(2023, 1, 5, 10, 0, 0)
+    assert parse_date("2023-01-05T10:00:00.5Z") == datetime(
+        2023, 1, 5, 10, 0, 0, 500000
+    )
+    assert parse_date("2023-01-05T12:00+02:00") == datetime(2023, 1, 5, 10, 0)
+    assert parse_date("2023-01-05T10:00:00.123456789-01:00") == datetime(
+        2023, 1, 5, 11, 0, 0, 123456
+    )
+    assert parse_date("2023-01-05") == datetime(2023, 1, 5)
+    assert parse_date("2023-01") == datetime(2023, 1, 1)
+    assert parse_date("2023") == datetime(2023, 1, 1)
+
+
+def test_parse_date_rfc822():
+    assert parse_date("Thu, 05 Jan 2023 10:00:00 GMT") == datetime(2023, 1, 5, 10)
+    assert parse_date("Thu, 05 Jan 2023 11:00:00 +0100") == datetime(2023, 1, 5, 10)
+    assert parse_date("yesterday") is None
+    assert parse_date("2023-13-05") is None
+    assert parse_date(None) is None
+
+
+def read_feed(data: bytes):
+    parser = FeedParser()
+    return parser.feed(data) + parser.close()
+
+
+def test_sitemap_lastmod_with_z():
+    entries = read_feed(b"""<?xml version="1.0" encoding="UTF-8"?>
+        <sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+          <sitemap>
+            <loc>https://example.com/sitemap-1.xml</loc>
+            <lastmod>2023-01-05T10:00:00Z</lastmod>
+          </sitemap>
+        </sitemapindex>""")
+    assert entries == [
+        (SITEMAP, "https://example.com/sitemap-1.xml", datetime(2023, 1, 5, 10))
+    ]
+    entries = read_feed(b"""<?xml version="1.0" encoding="UTF-8"?>
+        <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+          <url>
+            <loc>https://example.com/article/1</loc>
+            <lastmod>2023-01-05T10:00:00.000Z</lastmod>
+          </url>
+        </urlset>""")
+    assert entries == [
+        (PAGE, "https://example.com/article/1", datetime(2023, 1, 5, 10))
+    ]
+
+
+def test_discovery_skips_invalid_urls():
+    config = SiteConfig(name="example", urls=["https://example.com/"])
+    discovery = Discovery(Site(None, config), None)  # type: ignore
+    nested: List[str] = []
+    for loc in ["http://[broken/x", "mailto:news@example.com", "https://example.com/a"]:
+        asyncio.run(discovery.handle((PAGE, loc, None), nested))
+    assert list(discovery.found.keys()) == ["https://example.com/a"]
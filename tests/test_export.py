@@ -0,0 +1,64 @@
+import gzip
+import pytest
+from pathlib import Path
+from articledata import URL, Article
+
+from mediacrawl.export import JSONL_GZIP, Exporter, create_exporter
+
+
+def make_article(index: int) -> Article:
+    url = URL(f"https://example.com/article/{index}")
+    return Article(
+        id=url.id,
+        url=url,
+        title=f"Article {index}",
+        site="example",
+        bylines=[],
+        language="eng",
+        locale="en",
+        text="text " * 100,
+        extracted_at="2023-01-05T10:00:00",
+    )
+
+
+def read_shards(outpath: Path, site: str):
+    lines = []
+    for path in sorted(outpath.glob(f"{site}-*.ijson.gz")):
+        with gzip.open(path, "rb") as fh:
+            lines.extend(fh.read().splitlines())
+    return lines
+
+
+def test_compressed_export_removes_stale_shards(tmp_path: Path):
+    exporter = create_exporter(tmp_path, "example", JSONL_GZIP, rotate_size=1000)
+    exporter.write([make_article(i) for i in range(10)])
+    exporter.close()
+    assert len(list(tmp_path.glob("example-*.ijson.gz"))) > 2
+
+    # A smaller run must not leave files from the earlier run behind:
+    other = tmp_path.joinpath("example-other-00001.ijson.gz")
+    other.write_bytes(b"")
+    exporter = create_exporter(tmp_path, "example", JSONL_GZIP, rotate_size=1000)
+    exporter.write([make_article(0)])
+    exporter.close()
+    assert [p.name for p in tmp_path.glob("example-0*")] == ["example-00001.ijson.gz"]
+    assert len(read_shards(tmp_path, "example")) == 1
+    assert other.exists()
+
+
+def test_compressed_export_append(tmp_path: Path):
+    exporter = create_exporter(tmp_path, "example", JSONL_GZIP, rotate_size=1000)
+    exporter.write([make_article(i) for i in range(3)])
+    exporter.close()
+    count = len(list(tmp_path.glob("example-*.ijson.gz")))
+
+    exporter = create_exporter(tmp_path, "example", JSONL_GZIP, append=True)
+    exporter.write([make_article(3)])
+    exporter.close()
+    assert len(list(tmp_path.glob("example-*.ijson.gz"))) == count + 1
+    assert len(read_shards(tmp_path, "example")) == 4
+
+
+def test_exporter_is_abstract(tmp_path: Path):
+    with pytest.raises(TypeError):
+        Exporter(tmp_path, "example")  # type: ignore
@@ -0,0 +1,74 @@
+import orjson
+import asyncio
+from pathlib import Path
+from datetime import datetime
+from articledata import URL
+
+from mediacrawl.config import CrawlConfig
+from mediacrawl.db import db_connect, parsed_table
+from mediacrawl.page import Page
+from mediacrawl.parser import Parser
+
+config = CrawlConfig.parse_obj(
+    {"sites": [{"name": "example", "urls": ["https://example.com/"]}]}
+)
+
+
+def make_page(index: int, title: str) -> Page:
+    url = URL(f"https://example.com/article/{index}")
+    body = f"<html><head><title>{title}</title></head><body><article><p>"
+    body += "Some text of the article. " * 50
+    body += "</p></article></body></html>"
+    return Page(
+        site="example",
+        url=url,
+        original_url=url,
+        ok=True,
+        retrieved=True,
+        timestamp=datetime.utcnow(),
+        content_type="text/html",
+        content=body.encode("utf-8"),
+    )
+
+
+def read_titles(path: Path):
+    rows = [orjson.loads(line) for line in path.read_bytes().splitlines()]
+    return {row["id"]: row["title"] for row in rows}, len(rows)
+
+
+def test_incremental_after_full_parse(db, tmp_path: Path):
+    async def parse(pages, incremental: bool) -> None:
+        async with db_connect() as conn:
+            await Page.save_many(conn, pages)
+        await Parser(config).run(tmp_path, ["example"], incremental=incremental)
+
+    path = tmp_path.joinpath("example.ijson")
+    asyncio.run(parse([make_page(i, "First") for i in range(3)], False))
+    titles, lines = read_titles(path)
+    assert len(titles) == lines == 3
+
+    # Unchanged pages are skipped, and a changed one replaces its article:
+    asyncio.run(parse([make_page(1, "Second"), make_page(3, "Second")], True))
+    titles, lines = read_titles(path)
+    assert lines == 4
+    assert sorted(titles.values()) == ["First", "First", "Second", "Second"]
+    assert titles[URL("https://example.com/article/1").id] == "Second"
+
+
+def test_incremental_without_parse_state(db, tmp_path: Path):
+    async def parse(incremental: bool) -> None:
+        await Parser(config).run(tmp_path, ["example"], incremental=incremental)
+
+    async def forget() -> None:
+        async with db_connect() as conn:
+            await Page.save_many(conn, [make_page(i, "First") for i in range(3)])
+            await conn.execute(parsed_table.delete())
+
+    # Output written before parse state was recorded is replaced, not added to:
+    path = tmp_path.joinpath("example.ijson")
+    asyncio.run(forget())
+    asyncio.run(parse(False))
+    asyncio.run(forget())
+    asyncio.run(parse(True))
+    titles, lines = read_titles(path)
+    assert len(titles) == lines == 3
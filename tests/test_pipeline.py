@@ -0,0 +1,77 @@
+import orjson
+import asyncio
+from pathlib import Path
+from datetime import datetime
+from articledata import URL
+
+from mediacrawl.config import CrawlConfig
+from mediacrawl.metrics import Metrics
+from mediacrawl.page import Page
+from mediacrawl.pipeline import ParsePipeline, drop_replaced
+
+config = CrawlConfig.parse_obj(
+    {"sites": [{"name": "example", "urls": ["https://example.com/"]}]}
+)
+
+
+def make_page(index: int) -> Page:
+    url = URL(f"https://example.com/article/{index}")
+    body = f"<html><head><title>Article {index}</title></head><body><p>"
+    body += "Some text of the article. " * 50
+    body += "</p></body></html>"
+    return Page(
+        site="example",
+        url=url,
+        original_url=url,
+        ok=True,
+        retrieved=True,
+        timestamp=datetime.utcnow(),
+        content_type="text/html",
+        content=body.encode("utf-8"),
+    )
+
+
+def test_drop_replaced(tmp_path: Path):
+    path = tmp_path.joinpath("example.ijson")
+    before = [{"id": "a", "v": 1}, {"id": "b", "v": 1}, {"id": "c", "v": 1}]
+    after = [{"id": "b", "v": 2}, {"id": "d", "v": 2}]
+    with open(path, "wb") as fh:
+        for row in before:
+            fh.write(orjson.dumps(row) + b"\n")
+    offset = path.stat().st_size
+    with open(path, "ab") as fh:
+        for row in after:
+            fh.write(orjson.dumps(row) + b"\n")
+
+    # Articles of the crawl are kept even if their ID is replaced:
+    drop_replaced(path, offset, {"b", "d"})
+    rows = [orjson.loads(line) for line in path.read_bytes().splitlines()]
+    assert rows == [before[0], before[2]] + after
+    assert not tmp_path.joinpath("example.ijson.tmp").exists()
+
+
+def test_pipeline_survives_failed_batch(db, tmp_path: Path, monkeypatch):
+    skip_parsed = ParsePipeline.skip_parsed
+    calls = []
+
+    async def fail_once(self, pages):
+        calls.append(len(pages))
+        if len(calls) == 1:
+            raise RuntimeError("Database is down")
+        return await skip_parsed(self, pages)
+
+    monkeypatch.setattr(ParsePipeline, "skip_parsed", fail_once)
+
+    async def crawl() -> None:
+        pipeline = ParsePipeline(config, tmp_path, workers=1)
+        pipeline.start(Metrics())
+        await pipeline.put(make_page(1))
+        await pipeline.queue.put(None)
+        await pipeline.put(make_page(2))
+        await asyncio.wait_for(pipeline.close(), 60)
+
+    # The failed batch is lost, but the next one is still parsed:
+    asyncio.run(crawl())
+    assert calls == [1, 1]
+    lines = tmp_path.joinpath("example.ijson").read_bytes().splitlines()
+    assert [orjson.loads(line)["title"] for line in lines] == ["Article 2"]
@@ -0,0 +1,11 @@
+from mediacrawl.config import SiteConfig
+from mediacrawl.site import Site
+
+
+def test_time_budget_starts_with_crawl():
+    config = SiteConfig(name="example", urls=["https://example.com/"], max_time=0)
+    site = Site(None, config)  # type: ignore
+    # Time spent before the crawl, e.g. reading sitemaps, doesn't count:
+    assert not site.exhausted
+    site.start()
+    assert site.exhausted
@@ -0,0 +1,40 @@
+import asyncio
+from datetime import datetime
+from articledata import URL
+
+from mediacrawl.db import db_connect
+from mediacrawl.frontier import SEED, Frontier
+from mediacrawl.metrics import Metrics
+from mediacrawl.page import Page
+from mediacrawl.writer import PageWriter
+
+
+def test_writer_fails_unsaved_pages(db, monkeypatch):
+    async def save_many(conn, pages):
+        raise RuntimeError("Database is down")
+
+    monkeypatch.setattr(Page, "save_many", save_many)
+    url = URL("https://example.com/article/1")
+
+    async def crawl() -> int:
+        frontier = Frontier()
+        async with db_connect() as conn:
+            await frontier.resume(conn, "example")
+            frontier.push("example", url, 0, SEED)
+            await frontier.flush(conn)
+            assert len(await frontier.claim(conn, 10)) == 1
+
+        writer = PageWriter(Metrics(), frontier)
+        writer.start()
+        page = Page(
+            site="example", url=url, original_url=url, timestamp=datetime.utcnow()
+        )
+        await writer.put(page)
+        await writer.close()
+
+        # The URL must not be left active, or the crawl would never finish:
+        async with db_connect() as conn:
+            await frontier.flush(conn)
+            return await frontier.count_open(conn)
+
+    assert asyncio.run(crawl()) == 0